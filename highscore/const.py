@@ -18,4 +18,5 @@ class ConstMaster(object):
 
     MONTHLY_MODE  = 1
     LONGTERM_MODE = 2
+    DECAYED_MODE  = 3
 
@@ -0,0 +1,671 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import json
+import sqlalchemy as sa
+from twisted.python import log
+
+from highscore.const import ConstMaster as const
+
+class Aggregates(object):
+    # Maintenance of the derived tables that summarize the points table, so
+    # that leaderboards do not need to scan the points history.
+    #
+    # The thd_* methods run in a database thread.  Except where noted, they
+    # do not begin their own transaction; callers should wrap them in one
+    # along with the change to the points table that they reflect.
+    #
+    # The monthly totals cover points with `when >= watermark`; expiring
+    # points from those totals advances the watermark, which is kept in the
+    # state table.
+    #
+    # The decayed totals are sum(points * 2^((when - epoch) / halflife)) for
+    # an epoch also kept in the state table, so adding points never requires
+    # re-aging the existing ones, and ordering by the accumulator gives the
+    # same ranking as ordering by the decayed score.  The accumulators are
+    # rescaled to a new epoch every REBASE_HALFLIVES halflives to keep them
+    # within range of a single-precision float.
+    #
+    # The daily rollups hold each user's points for each UTC day.  Raw points
+    # from before the day-aligned compaction watermark, also kept in the state
+    # table, may have been deleted, so the rollups for those days are the only
+    # record of them.
+    #
+    # The totals and rollups are kept for several scopes: the global scope ''
+    # and, for each point, 'source:<source>', 'repo:<repo>' and
+    # 'event:<event_type>' for whichever of those it has, so that leaderboards
+    # filtered by one of them cost no more than the global leaderboard.  The
+    # decayed totals are only kept globally.
+
+    MONTHLY_WATERMARK = 'points.monthly_watermark'
+    DECAY_EPOCH = 'points.decay_epoch'
+    COMPACTED_UNTIL = 'points.compacted_until'
+    REBASE_HALFLIVES = 8
+    DAY = 3600*24
+
+    # scope prefix -> points column
+    SCOPE_COLUMNS = dict(source='source', repo='repo', event='event_type')
+
+    def __init__(self, model, halflife):
+        self.model = model
+        self.halflife = halflife
+
+    def thd_addPoints(self, conn, rows, sign=1):
+        # rows is a list of dictionaries with keys userid, when, points,
+        # source, repo, and event_type.  With a sign of -1, the rows are
+        # taken back out of the aggregates.
+        watermark = self._thd_getState(conn, self.MONTHLY_WATERMARK)
+
+        deltas = {}
+        for row in rows:
+            modes = [ const.LONGTERM_MODE ]
+            if watermark is None or row['when'] >= watermark:
+                modes.append(const.MONTHLY_MODE)
+            for mode in modes:
+                for scope in self.scopes(row):
+                    key = (row['userid'], mode, scope)
+                    deltas[key] = deltas.get(key, 0) + sign * row['points']
+
+        for (userid, mode, scope), delta in sorted(deltas.iteritems()):
+            self._thd_adjustTotal(conn, userid, mode, delta, scope)
+
+        epoch = self.thd_getDecayEpoch(conn,
+                                       max(row['when'] for row in rows))
+        scores = {}
+        for row in rows:
+            scores[row['userid']] = scores.get(row['userid'], 0) + \
+                    sign * row['points'] / self.decay(epoch, row['when'])
+        for userid, delta in sorted(scores.iteritems()):
+            self._thd_adjustDecayed(conn, userid, delta)
+
+        daily = {}
+        for row in rows:
+            for scope in self.scopes(row):
+                key = (row['userid'], self.day(row['when']), scope)
+                points, count = daily.get(key, (0, 0))
+                daily[key] = (points + sign * row['points'], count + sign)
+        for (userid, day, scope), (points, count) in \
+                sorted(daily.iteritems()):
+            self._thd_adjustDaily(conn, userid, day, points, count, scope)
+
+    def thd_movePoints(self, conn, rows, userid):
+        # move points, as for thd_addPoints, from the users in the rows to
+        # 'userid'
+        self.thd_noteMerge(conn)
+        self.thd_addPoints(conn, rows, sign=-1)
+        self.thd_addPoints(conn, [ dict(row, userid=userid) for row in rows ])
+
+    def thd_mergeBatch(self, conn, src, dst, limit):
+        # move src's daily rollups for days before the compaction watermark,
+        # whose raw points are no longer in the points table, to dst, along
+        # with their part of the career and decayed totals.  Rollups for later
+        # days reflect raw points, which are moved with thd_movePoints; that
+        # includes any points given to src while it is being merged.  This
+        # moves up to 'limit' rollups in its own transaction and returns the
+        # number moved; call it until that is zero.  The last call also
+        # removes the empty rows that moving src's points leaves behind.
+        totalsTbl = self.model.user_totals
+        decayedTbl = self.model.decayed_totals
+        dailyTbl = self.model.points_daily
+
+        transaction = conn.begin()
+        try:
+            self.thd_noteMerge(conn)
+            compacted = self._thd_getState(conn, self.COMPACTED_UNTIL) or 0
+            epoch = self._thd_getState(conn, self.DECAY_EPOCH)
+            rows = conn.execute(sa.select([ dailyTbl ],
+                    (dailyTbl.c.userid == src) &
+                    (dailyTbl.c.day < self.day(compacted)),
+                    order_by=[ dailyTbl.c.day ],
+                    limit=limit)).fetchall()
+            for row in rows:
+                # compaction never reaches points in the monthly totals, so
+                # only the career totals include these days
+                for userid, sign in (src, -1), (dst, 1):
+                    self._thd_adjustTotal(conn, userid, const.LONGTERM_MODE,
+                                          sign * row.points, row.scope)
+                    if row.scope == '' and epoch is not None:
+                        # as in thd_computeAggregates, a compacted day counts
+                        # as of midday
+                        self._thd_adjustDecayed(conn, userid,
+                                sign * row.points /
+                                self.decay(epoch, (row.day + 0.5) * self.DAY))
+                self._thd_adjustDaily(conn, dst, row.day, row.points,
+                                      row.count, row.scope)
+                conn.execute(dailyTbl.delete(
+                    (dailyTbl.c.userid == src) & (dailyTbl.c.day == row.day) &
+                    (dailyTbl.c.scope == row.scope)))
+
+            if len(rows) < limit:
+                conn.execute(totalsTbl.delete(
+                    (totalsTbl.c.userid == src) & (totalsTbl.c.points == 0)))
+                conn.execute(dailyTbl.delete(
+                    (dailyTbl.c.userid == src) & (dailyTbl.c.count == 0) &
+                    (dailyTbl.c.points == 0)))
+                # with no points left, src's decayed total is only rounding
+                if not conn.execute(sa.select([ dailyTbl.c.day ],
+                        dailyTbl.c.userid == src, limit=1)).fetchall():
+                    conn.execute(decayedTbl.delete(
+                        decayedTbl.c.userid == src))
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        return len(rows)
+
+    def scopes(self, row):
+        # the scopes that a point, given as a row or dictionary, counts in
+        scopes = [ '' ]
+        for prefix, column in sorted(self.SCOPE_COLUMNS.iteritems()):
+            if row[column] is not None:
+                scopes.append('%s:%s' % (prefix, row[column]))
+        return scopes
+
+    def scopeClause(self, tbl, scope):
+        # a where clause selecting the points in tbl that count in 'scope'
+        prefix, value = scope.split(':', 1)
+        return (tbl.c[self.SCOPE_COLUMNS[prefix]] == value)
+
+    def day(self, when):
+        # the day number (days since the epoch) containing 'when'
+        return int(when // self.DAY)
+
+    def decay(self, epoch, now):
+        # the multiplier that converts a decayed accumulator to its value at
+        # time 'now'
+        return 2.0 ** ((epoch - now) / float(self.halflife))
+
+    def thd_getDecayEpoch(self, conn, now):
+        # get the decay epoch, rebasing the accumulators first if it is too
+        # far in the past
+        epoch = self._thd_getState(conn, self.DECAY_EPOCH)
+        if epoch is not None and \
+                now - epoch < self.halflife * self.REBASE_HALFLIVES:
+            return epoch
+
+        tbl = self.model.decayed_totals
+        new_epoch = int(now)
+        transaction = conn.begin()
+        try:
+            if epoch is not None:
+                log.msg("rebasing decayed totals to epoch %d" % (new_epoch,))
+                conn.execute(tbl.update().values(
+                    score=tbl.c.score * self.decay(epoch, new_epoch)))
+            self._thd_setState(conn, self.DECAY_EPOCH, new_epoch)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        return new_epoch
+
+    def thd_expireMonthly(self, conn, now):
+        # subtract points older than HALFLIFE from the monthly totals, and
+        # return a dictionary mapping userid to the number of points expired.
+        # This runs its own transaction.
+        pointsTbl = self.model.points
+        totalsTbl = self.model.user_totals
+        cutoff = now - self.halflife
+
+        transaction = conn.begin()
+        try:
+            watermark = self._thd_getState(conn, self.MONTHLY_WATERMARK)
+            if watermark is None:
+                transaction.rollback()
+                log.msg("no monthly watermark; rebuilding aggregates")
+                self.thd_rebuild(conn, now)
+                return {}
+            if cutoff <= watermark:
+                transaction.commit()
+                return {}
+
+            groups = [ pointsTbl.c.userid, pointsTbl.c.source,
+                       pointsTbl.c.repo, pointsTbl.c.event_type ]
+            res = conn.execute(sa.select(
+                groups + [ sa.func.sum(pointsTbl.c.points).label('points') ],
+                (pointsTbl.c.when >= watermark) &
+                (pointsTbl.c.when < cutoff) &
+                (pointsTbl.c.userid != None),
+                group_by=groups))
+            deltas = {}
+            for row in res:
+                for scope in self.scopes(row):
+                    key = (row.userid, scope)
+                    deltas[key] = deltas.get(key, 0) + row.points
+            expired = dict((userid, total)
+                           for (userid, scope), total in deltas.iteritems()
+                           if scope == '')
+
+            for (userid, scope), total in sorted(deltas.iteritems()):
+                self._thd_adjustTotal(conn, userid, const.MONTHLY_MODE,
+                                      -total, scope)
+            if expired:
+                # users with nothing left in the window drop off the board
+                conn.execute(totalsTbl.delete(
+                    (totalsTbl.c.mode == const.MONTHLY_MODE) &
+                    (totalsTbl.c.points == 0) &
+                    (totalsTbl.c.userid.in_(expired.keys()))))
+
+            self._thd_setState(conn, self.MONTHLY_WATERMARK, cutoff)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        return expired
+
+    def thd_rebuild(self, conn, now):
+        # recompute all aggregates from the points table and, for days before
+        # the compaction watermark, from the daily rollups.  This runs its own
+        # transaction.
+        transaction = conn.begin()
+        try:
+            compacted = self._thd_getState(conn, self.COMPACTED_UNTIL) or 0
+            epoch = int(now)
+            self._thd_replaceAggregates(conn, compacted,
+                    *self.thd_computeAggregates(conn, now, epoch, compacted))
+            self._thd_setState(conn, self.DECAY_EPOCH, epoch)
+            self._thd_setState(conn, self.MONTHLY_WATERMARK,
+                               now - self.halflife)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+
+    def thd_computeAggregates(self, conn, now, epoch, compacted,
+                              userids=None, maxId=None):
+        # compute the aggregates as of 'now' for the users with ids in
+        # [lo, hi) if 'userids' is given, counting only the points with ids up
+        # to 'maxId' if it is given.  Returns lists of rows for the
+        # uncompacted days of points_daily, decayed_totals relative to
+        # 'epoch', and user_totals.
+        pointsTbl = self.model.points
+        dailyTbl = self.model.points_daily
+        cutoff = now - self.halflife
+        firstRawDay = self.day(compacted)
+
+        daily = {}
+        scores = {}
+        totals = {}
+
+        # rollups for the uncompacted days, the decayed scores, and the
+        # monthly totals come from the raw points, which are never compacted
+        # until they have expired
+        whereclause = ((pointsTbl.c.when >= firstRawDay * self.DAY) &
+                       (pointsTbl.c.userid != None))
+        if userids is not None:
+            whereclause &= ((pointsTbl.c.userid >= userids[0]) &
+                            (pointsTbl.c.userid < userids[1]))
+        if maxId is not None:
+            whereclause &= (pointsTbl.c.id <= maxId)
+        res = conn.execute(sa.select(
+            [ pointsTbl.c.userid, pointsTbl.c.when, pointsTbl.c.points,
+              pointsTbl.c.source, pointsTbl.c.repo, pointsTbl.c.event_type ],
+            whereclause))
+        for row in res:
+            scores[row.userid] = scores.get(row.userid, 0) + \
+                    row.points / self.decay(epoch, row.when)
+            for scope in self.scopes(row):
+                key = (row.userid, self.day(row.when), scope)
+                points, count = daily.get(key, (0, 0))
+                daily[key] = (points + row.points, count + 1)
+                if row.when >= cutoff:
+                    key = (row.userid, const.MONTHLY_MODE, scope)
+                    totals[key] = totals.get(key, 0) + row.points
+
+        # compacted days contribute to the decayed scores as of midday
+        longterm = {}
+        whereclause = (dailyTbl.c.day < firstRawDay)
+        if userids is not None:
+            whereclause &= ((dailyTbl.c.userid >= userids[0]) &
+                            (dailyTbl.c.userid < userids[1]))
+        res = conn.execute(sa.select(
+            [ dailyTbl.c.userid, dailyTbl.c.day, dailyTbl.c.scope,
+              dailyTbl.c.points ],
+            whereclause))
+        for row in res:
+            if row.scope == '':
+                scores[row.userid] = scores.get(row.userid, 0) + \
+                        row.points / self.decay(epoch,
+                                                (row.day + 0.5) * self.DAY)
+            key = (row.userid, row.scope)
+            longterm[key] = longterm.get(key, 0) + row.points
+
+        # career totals come from all of the rollups
+        for (userid, day, scope), (points, count) in daily.iteritems():
+            key = (userid, scope)
+            longterm[key] = longterm.get(key, 0) + points
+        for (userid, scope), points in longterm.iteritems():
+            totals[(userid, const.LONGTERM_MODE, scope)] = points
+
+        return ([ dict(userid=userid, day=day, scope=scope, points=points,
+                       count=count)
+                  for (userid, day, scope), (points, count)
+                  in daily.iteritems() ],
+                [ dict(userid=userid, score=score)
+                  for userid, score in scores.iteritems() ],
+                [ dict(userid=userid, mode=mode, scope=scope, points=points)
+                  for (userid, mode, scope), points in totals.iteritems() ])
+
+    def _thd_replaceAggregates(self, conn, compacted, daily, scores, totals):
+        # replace the uncompacted rollups and all of the totals with the given
+        # lists of rows
+        dailyTbl = self.model.points_daily
+        conn.execute(dailyTbl.delete(dailyTbl.c.day >= self.day(compacted)))
+        for tbl, rows in [ (dailyTbl, daily),
+                           (self.model.decayed_totals, scores),
+                           (self.model.user_totals, totals) ]:
+            if tbl is not dailyTbl:
+                conn.execute(tbl.delete())
+            if rows:
+                conn.execute(tbl.insert(), rows)
+
+    # parallel rebuilds
+    #
+    # A rebuild can be split across processes by userid range.  A plan in the
+    # state table fixes the time, epoch, last point id and ranges; each range
+    # is computed into the rebuild_* staging tables and marked done in its own
+    # transaction, so that an interrupted rebuild can be resumed; and finally
+    # the staged rows replace the aggregates in a single transaction, which
+    # also applies any points added since the plan was made.  Points moved
+    # from one user to another by a merge can't be caught up that way, so
+    # every merge batch increments a counter in the state table, and the
+    # rebuild fails if it has changed.  Finishing a rebuild increments the
+    # aggregates' generation, which a running bot checks so that it can
+    # reload its rank indexes.
+
+    REBUILD_PLAN = 'aggregates.rebuild'
+    REBUILD_DONE = 'aggregates.rebuild.%d'
+    MERGE_COUNT = 'aggregates.merges'
+    GENERATION = 'aggregates.generation'
+
+    def thd_noteMerge(self, conn):
+        # record that points are being moved between users; call this in the
+        # transaction that moves them
+        self._thd_setState(conn, self.MERGE_COUNT,
+                (self._thd_getState(conn, self.MERGE_COUNT) or 0) + 1)
+
+    def thd_getGeneration(self, conn):
+        return self._thd_getState(conn, self.GENERATION) or 0
+
+    def thd_planRebuild(self, conn, now, rangeSize):
+        # return the plan for the rebuild in progress, or make a new one.  The
+        # plan is a dictionary with keys now, epoch, maxId, compacted, merges
+        # and ranges, and also, not stored, done: the indexes of completed
+        # ranges.
+        transaction = conn.begin()
+        try:
+            plan = self._thd_getState(conn, self.REBUILD_PLAN)
+            if plan is None:
+                pointsTbl = self.model.points
+                usersTbl = self.model.users
+                maxUserId = conn.execute(sa.select(
+                    [ sa.func.max(usersTbl.c.id) ])).scalar() or 0
+                plan = dict(now=now, epoch=int(now),
+                    maxId=conn.execute(sa.select(
+                        [ sa.func.max(pointsTbl.c.id) ])).scalar() or 0,
+                    compacted=self._thd_getState(conn,
+                                                 self.COMPACTED_UNTIL) or 0,
+                    merges=self._thd_getState(conn, self.MERGE_COUNT) or 0,
+                    ranges=[ (lo, lo + rangeSize)
+                             for lo in xrange(0, maxUserId + 1, rangeSize) ])
+                for tbl in self._stagingTables():
+                    conn.execute(tbl.delete())
+                self._thd_setState(conn, self.REBUILD_PLAN, plan)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+
+        plan['done'] = [ i for i in xrange(len(plan['ranges']))
+                         if self._thd_getState(conn, self.REBUILD_DONE % i) ]
+        return plan
+
+    def thd_rebuildRange(self, conn, plan, i):
+        # compute the aggregates for the plan's i'th userid range into the
+        # staging tables.  This runs its own transaction, and returns the
+        # number of raw points read.
+        aggregates = self.thd_computeAggregates(conn,
+                plan['now'], plan['epoch'], plan['compacted'],
+                userids=plan['ranges'][i], maxId=plan['maxId'])
+        transaction = conn.begin()
+        try:
+            for tbl, rows in zip(self._stagingTables(), aggregates):
+                if rows:
+                    conn.execute(tbl.insert(), rows)
+            self._thd_setState(conn, self.REBUILD_DONE % i, True)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        return sum(row['count'] for row in aggregates[0]
+                   if row['scope'] == '')
+
+    def thd_finishRebuild(self, conn, plan):
+        # replace the aggregates with the staged rows and discard the plan;
+        # returns the number of points added since the plan was made.  This
+        # fails if points were compacted or users merged since then.
+        model = self.model
+        pointsTbl = model.points
+        transaction = conn.begin()
+        try:
+            if (self._thd_getState(conn, self.COMPACTED_UNTIL) or 0) \
+                    != plan['compacted']:
+                raise RuntimeError("points were compacted during the rebuild; "
+                                   "discard it and start again")
+            if (self._thd_getState(conn, self.MERGE_COUNT) or 0) \
+                    != plan.get('merges', 0):
+                raise RuntimeError("users were merged during the rebuild; "
+                                   "discard it and start again")
+            self._thd_replaceAggregates(conn, plan['compacted'],
+                *[ [ dict(row) for row in conn.execute(tbl.select()) ]
+                   for tbl in self._stagingTables() ])
+            self._thd_setState(conn, self.DECAY_EPOCH, plan['epoch'])
+            self._thd_setState(conn, self.MONTHLY_WATERMARK,
+                               plan['now'] - self.halflife)
+
+            res = conn.execute(sa.select(
+                [ pointsTbl.c.userid, pointsTbl.c.when, pointsTbl.c.points,
+                  pointsTbl.c.source, pointsTbl.c.repo,
+                  pointsTbl.c.event_type ],
+                (pointsTbl.c.id > plan['maxId']) &
+                (pointsTbl.c.userid != None)))
+            rows = [ dict(row) for row in res ]
+            if rows:
+                self.thd_addPoints(conn, rows)
+
+            self._thd_discardRebuild(conn, plan)
+            self._thd_setState(conn, self.GENERATION,
+                               self.thd_getGeneration(conn) + 1)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        return len(rows)
+
+    def thd_discardRebuild(self, conn):
+        # forget any rebuild in progress
+        transaction = conn.begin()
+        try:
+            plan = self._thd_getState(conn, self.REBUILD_PLAN)
+            if plan is not None:
+                self._thd_discardRebuild(conn, plan)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+
+    def _thd_discardRebuild(self, conn, plan):
+        stateTbl = self.model.state
+        for tbl in self._stagingTables():
+            conn.execute(tbl.delete())
+        conn.execute(stateTbl.delete(stateTbl.c.name.in_(
+            [ self.REBUILD_PLAN ] +
+            [ self.REBUILD_DONE % i for i in xrange(len(plan['ranges'])) ])))
+
+    def _stagingTables(self):
+        # in the order taken by _thd_replaceAggregates
+        return [ self.model.rebuild_points_daily,
+                 self.model.rebuild_decayed_totals,
+                 self.model.rebuild_user_totals ]
+
+    def thd_startCompaction(self, conn, horizon):
+        # begin compacting raw points older than 'horizon', but never points
+        # that are still in the monthly totals.  This advances the compaction
+        # watermark and returns it; raw points older than the watermark can
+        # then be deleted with thd_compactBatch.
+        transaction = conn.begin()
+        try:
+            compacted = self._thd_getState(conn, self.COMPACTED_UNTIL) or 0
+            watermark = self._thd_getState(conn, self.MONTHLY_WATERMARK)
+            if watermark is None:
+                transaction.commit()
+                return compacted
+            cutoff = self.day(min(horizon, watermark)) * self.DAY
+            if cutoff > compacted:
+                self._thd_setState(conn, self.COMPACTED_UNTIL, cutoff)
+                compacted = cutoff
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        return compacted
+
+    def thd_compactBatch(self, conn, cutoff, limit, archive=False):
+        # remove up to 'limit' raw points older than 'cutoff', which must not
+        # be later than the compaction watermark; their totals remain in the
+        # daily rollups.  If 'archive' is true, the points are copied to the
+        # points_archive table first.  This runs its own transaction, and
+        # returns the number of points removed.
+        pointsTbl = self.model.points
+        archiveTbl = self.model.points_archive
+
+        transaction = conn.begin()
+        try:
+            res = conn.execute(sa.select([ pointsTbl ],
+                    pointsTbl.c.when < cutoff,
+                    order_by=[ pointsTbl.c.when ],
+                    limit=limit))
+            rows = [ dict(row) for row in res ]
+            if rows:
+                if archive:
+                    conn.execute(archiveTbl.insert(), rows)
+                conn.execute(pointsTbl.delete(
+                    pointsTbl.c.id.in_([ row['id'] for row in rows ])))
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        return len(rows)
+
+    def thd_windowQuery(self, conn, start, end, scope=''):
+        # return a selectable of (userid, points) rows whose per-user sums are
+        # the points earned in [start, end) in the given scope.  Whole days
+        # come from the daily rollups, and only the partial days at either
+        # edge from the raw points.  A partial day before the compaction
+        # watermark is no longer in the raw points, so the window is widened
+        # to include all of it.
+        pointsTbl = self.model.points
+        dailyTbl = self.model.points_daily
+        compacted = self._thd_getState(conn, self.COMPACTED_UNTIL) or 0
+
+        firstDay = lastDay = None
+        if start is not None:
+            if start < compacted:
+                start = self.day(start) * self.DAY
+            firstDay = -self.day(-start) # round up
+        if end is not None:
+            if end <= compacted:
+                end = -self.day(-end) * self.DAY
+            lastDay = self.day(end)
+
+        queries = []
+        edges = []
+        if firstDay is not None and lastDay is not None and \
+                firstDay >= lastDay:
+            # no whole days
+            edges.append((start, end))
+        else:
+            if firstDay is not None and start < firstDay * self.DAY:
+                edges.append((start, firstDay * self.DAY))
+            if lastDay is not None and end > lastDay * self.DAY:
+                edges.append((lastDay * self.DAY, end))
+
+            query = sa.select([ dailyTbl.c.userid.label('userid'),
+                                dailyTbl.c.points.label('points') ],
+                              dailyTbl.c.scope == scope)
+            if firstDay is not None:
+                query = query.where(dailyTbl.c.day >= firstDay)
+            if lastDay is not None:
+                query = query.where(dailyTbl.c.day < lastDay)
+            queries.append(query)
+
+        for edgeStart, edgeEnd in edges:
+            whereclause = ((pointsTbl.c.when >= edgeStart) &
+                           (pointsTbl.c.when < edgeEnd) &
+                           (pointsTbl.c.userid != None))
+            if scope:
+                whereclause &= self.scopeClause(pointsTbl, scope)
+            queries.append(sa.select([ pointsTbl.c.userid.label('userid'),
+                                       pointsTbl.c.points.label('points') ],
+                                     whereclause))
+        if len(queries) == 1:
+            return queries[0].alias('window')
+        return sa.union_all(*queries).alias('window')
+
+    def _thd_adjustTotal(self, conn, userid, mode, delta, scope=''):
+        tbl = self.model.user_totals
+        res = conn.execute(tbl.update(
+                (tbl.c.userid == userid) & (tbl.c.mode == mode) &
+                (tbl.c.scope == scope)).values(
+                points=tbl.c.points + delta))
+        if res.rowcount:
+            return
+        conn.execute(tbl.insert(), userid=userid, mode=mode, scope=scope,
+                     points=delta)
+
+    def _thd_adjustDecayed(self, conn, userid, delta):
+        tbl = self.model.decayed_totals
+        res = conn.execute(tbl.update(tbl.c.userid == userid).values(
+                score=tbl.c.score + delta))
+        if res.rowcount:
+            return
+        conn.execute(tbl.insert(), userid=userid, score=delta)
+
+    def _thd_adjustDaily(self, conn, userid, day, points, count, scope=''):
+        tbl = self.model.points_daily
+        res = conn.execute(tbl.update(
+                (tbl.c.userid == userid) & (tbl.c.day == day) &
+                (tbl.c.scope == scope)).values(
+                points=tbl.c.points + points,
+                count=tbl.c.count + count))
+        if res.rowcount:
+            return
+        conn.execute(tbl.insert(), userid=userid, day=day, scope=scope,
+                     points=points, count=count)
+
+    def _thd_getState(self, conn, name):
+        tbl = self.model.state
+        res = conn.execute(sa.select([ tbl.c.value ], tbl.c.name == name))
+        row = res.fetchone()
+        res.close()
+        if row:
+            return json.loads(row.value)
+
+    def _thd_setState(self, conn, name, value):
+        tbl = self.model.state
+        value_json = json.dumps(value)
+        res = conn.execute(tbl.update(tbl.c.name == name), value=value_json)
+        if res.rowcount:
+            return
+        conn.execute(tbl.insert(), name=name, value=value_json)
@@ -17,7 +17,7 @@ import sqlalchemy as sa
 import json
 from twisted.python import log
 from twisted.application import service
-from highscore.db import enginestrategy, pool, model
+from highscore.db import enginestrategy, pool, model, maintenance
 
 class DBConnector(service.MultiService):
 
@@ -34,7 +34,18 @@ class DBConnector(service.MultiService):
         self._engine = enginestrategy.create_engine(db_url,
                               basedir=self.config.get('basedir'))
         self.model = model.Model(self)
-        self.pool = pool.DBThreadPool(self._engine)
+        self.pool = pool.DBThreadPool(self._engine,
+                pool_size=config.db.get('pool_size'),
+                max_pool_size=config.db.get('max_pool_size'),
+                grow_wait=config.db.get('pool_grow_wait', 0.1),
+                read_pool_size=config.db.get('read_pool_size'),
+                group_commit_window=config.db.get('group_commit_window'),
+                group_commit_max=config.db.get('group_commit_max', 100),
+                slow_query_time=config.db.get('slow_query_time'),
+                retry_deadline=config.db.get('retry_deadline'))
+
+        self.maintenance = maintenance.DBMaintenance(highscore, config)
+        self.maintenance.setServiceParent(self)
 
     def setup(self):
         d = self.model.is_current()
@@ -55,7 +66,7 @@ class DBConnector(service.MultiService):
             res = conn.execute(
                 sa.select([ tbl.c.value ], tbl.c.name == name))
             return res.fetchone()
-        d = self.pool.do(thd)
+        d = self.pool.do_read(thd)
         @d.addCallback
         def un_json(row):
             if row:
@@ -75,5 +86,5 @@ class DBConnector(service.MultiService):
                 self.model.state.insert(),
                 name=name,
                 value=value_json)
-        return self.pool.do(thd)
+        return self.pool.do_grouped(thd)
 
@@ -13,9 +13,11 @@
 #
 # Copyright Buildbot Team Members
 
+import os
 import sqlalchemy as sa
 from twisted.python import log
 from sqlalchemy.engine import strategies, url
+from sqlalchemy.pool import NullPool
 from highscore.util import sautils
 
 class HighscoreEngineStrategy(strategies.ThreadLocalEngineStrategy):
@@ -32,21 +34,22 @@ class HighscoreEngineStrategy(strategies.ThreadLocalEngineStrategy):
         """
         For sqlite, percent-substitute %(basedir)s and use a full
         path to the basedir.  If using a memory database, force the
-        pool size to be 1.
+        pool size to be 1.  SQLite has a single write lock, so more than
+        one thread only adds contention for it; the optimal thread pool
+        size is 1.
         """
+        max_conns = 1
         if u.database:
-            kwargs.setdefault('poolclass', NullPoll)
+            kwargs.setdefault('poolclass', NullPool)
             u.database = u.database % dict(basedir = kwargs['basedir'])
-            if not os.path.isabs(u.database[0]):
+            if not os.path.isabs(u.database):
                 u.database = os.path.join(kwargs['basedir'], u.database)
 
         if not u.database:
             kwargs['pool_size'] = 1
-            max_conns = 1
 
-        if 'serialize_access' in u.query:
-            u.query.pop('serialize_access')
-            max_conns = 1
+        # serialized access is now the default, but accept the old argument
+        u.query.pop('serialize_access', None)
 
         return u, kwargs, max_conns
 
@@ -69,7 +72,9 @@ class HighscoreEngineStrategy(strategies.ThreadLocalEngineStrategy):
 
             log.msg("setting database journal mode to 'wal'")
             try:
-                engine.execute("pragma journal_mode = wal")
+                mode = engine.execute("pragma journal_mode = wal").scalar()
+                # readers and the writer do not block each other in WAL mode
+                engine.wal_mode = (mode == 'wal')
             except:
                 log.msg("failed to set journal mode - database may fail")
 
@@ -152,6 +157,7 @@ class HighscoreEngineStrategy(strategies.ThreadLocalEngineStrategy):
         engine = strategies.ThreadLocalEngineStrategy.create(self, u, **kwargs)
 
         engine.optimal_thread_pool_size = max_conns
+        engine.wal_mode = False
 
         engine.highscore_basedir = basedir
 
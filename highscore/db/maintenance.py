@@ -0,0 +1,121 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import time
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+from twisted.application import service, internet
+
+class DBMaintenance(service.MultiService):
+    # Periodic maintenance to keep the database from growing without bound.
+    # Each pass moves points older than archive_age seconds into the
+    # points_archive table, archive_chunk rows per transaction so that writers
+    # are not blocked for long, and then, for SQLite, returns the freed pages
+    # to the filesystem with incremental_vacuum, vacuum_pages per query so
+    # that other queries can run in between.  The
+    # archived points remain counted in the daily rollups.  Archiving shares
+    # PointsManager.compactPoints, and its lock, with the points compactor.
+    #
+    # An existing database needs a one-time full VACUUM before incremental
+    # vacuuming works.  That blocks all writes while it runs, so it is only
+    # done if an administrator sets db.full_vacuum.
+
+    def __init__(self, highscore, config):
+        service.MultiService.__init__(self)
+        self.setName('highscore.db.maintenance')
+        self.highscore = highscore
+
+        self.archiveAge = config.db.get('archive_age')
+        self.archiveChunk = config.db.get('archive_chunk', 1000)
+        self.vacuumPages = config.db.get('vacuum_pages', 1000)
+        self.fullVacuum = config.db.get('full_vacuum', False)
+        self._vacuumWarned = False
+
+        # statistics from the last pass
+        self.lastRun = None
+
+        interval = config.db.get('maintenance_interval')
+        if interval:
+            timer = internet.TimerService(interval, self._maintainTimer)
+            timer.setServiceParent(self)
+
+    @defer.inlineCallbacks
+    def maintain(self):
+        stats = {}
+        if self.archiveAge:
+            started = time.time()
+            moved = yield self.highscore.points.compactPoints(
+                    horizon=self.archiveAge, archive=True,
+                    batch=self.archiveChunk)
+            elapsed = time.time() - started
+            stats.update(archived=moved, archive_time=elapsed)
+            log.msg("archived %d points in %.1fs (%.0f rows/s)" %
+                    (moved, elapsed, moved / elapsed if elapsed else 0))
+
+        pool = self.highscore.db.pool
+        if pool.engine.dialect.name == 'sqlite':
+            started = time.time()
+            freed = 0
+            while True:
+                step = yield pool.do(self.thd_incrementalVacuum)
+                freed += step
+                if step < self.vacuumPages:
+                    break
+                # let anything waiting in the reactor run between chunks
+                yield task.deferLater(reactor, 0, lambda : None)
+            elapsed = time.time() - started
+            stats.update(vacuumed_pages=freed, vacuum_time=elapsed)
+            if freed:
+                log.msg("freed %d database pages in %.1fs" % (freed, elapsed))
+
+        self.lastRun = stats
+        defer.returnValue(stats)
+
+    def _maintainTimer(self):
+        d = self.maintain()
+        d.addErrback(log.err, 'while maintaining the database')
+        return d
+
+    def thd_incrementalVacuum(self, conn):
+        # incremental_vacuum only works once auto_vacuum is INCREMENTAL (2),
+        # which an existing database only picks up after a full VACUUM
+        if conn.execute("pragma auto_vacuum").scalar() != 2:
+            if not self.fullVacuum:
+                if self._vacuumWarned:
+                    return 0
+                self._vacuumWarned = True
+                log.msg("not vacuuming: set db.full_vacuum to run the "
+                        "one-time full VACUUM that incremental vacuuming "
+                        "needs; it blocks writes while it runs")
+                return 0
+            log.msg("enabling incremental vacuum; vacuuming the database")
+            conn.execute("pragma auto_vacuum = incremental")
+            conn.execute("vacuum")
+            return 0
+
+        # free up to vacuumPages pages, returning the number freed.  pysqlite
+        # only steps a statement once unless its results are fetched, and
+        # incremental_vacuum frees one page per step, so use the raw cursor
+        free = conn.execute("pragma freelist_count").scalar()
+        if not free:
+            return 0
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute("pragma incremental_vacuum(%d)"
+                           % min(free, self.vacuumPages))
+            cursor.fetchall()
+        finally:
+            cursor.close()
+        return max(free - conn.execute("pragma freelist_count").scalar(), 0)
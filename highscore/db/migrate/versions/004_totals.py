@@ -0,0 +1,83 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import time
+import json
+import sqlalchemy as sa
+
+# values of ConstMaster.MONTHLY_MODE, ConstMaster.LONGTERM_MODE and
+# PointsManager.HALFLIFE at the time of this migration
+MONTHLY_MODE = 1
+LONGTERM_MODE = 2
+HALFLIFE = 3600*24*30
+
+def upgrade(migrate_engine):
+    metadata = sa.MetaData()
+    metadata.bind = migrate_engine
+
+    sa.Table('users', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('display_name', sa.Text, nullable=False),
+    )
+
+    points = sa.Table('points', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id')),
+        sa.Column('when', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('comments', sa.Text, nullable=False),
+    )
+
+    state = sa.Table('state', metadata,
+        sa.Column('name', sa.String(256), primary_key=True),
+        sa.Column('value', sa.Text, nullable=False),
+    )
+
+    user_totals = sa.Table('user_totals', metadata,
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id'),
+                    nullable=False),
+        sa.Column('mode', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+    )
+    user_totals.create()
+
+    sa.Index('user_totals_userid_mode',
+            user_totals.c.userid,
+            user_totals.c.mode,
+            unique=True).create()
+    sa.Index('user_totals_mode_points',
+            user_totals.c.mode,
+            user_totals.c.points).create()
+
+    # used to expire points from the monthly totals
+    sa.Index('points_when', points.c.when).create()
+
+    # populate the totals from the existing points
+    cutoff = time.time() - HALFLIFE
+    for mode, whereclause in [
+            (LONGTERM_MODE, points.c.when > 0),
+            (MONTHLY_MODE, points.c.when >= cutoff) ]:
+        res = migrate_engine.execute(sa.select(
+            [ points.c.userid, sa.func.sum(points.c.points).label('total') ],
+            whereclause & (points.c.userid != None),
+            group_by=[ points.c.userid ]))
+        rows = [ dict(userid=row.userid, mode=mode, points=row.total)
+                 for row in res ]
+        if rows:
+            migrate_engine.execute(user_totals.insert(), rows)
+
+    migrate_engine.execute(state.insert(),
+            name='points.monthly_watermark',
+            value=json.dumps(cutoff))
@@ -0,0 +1,70 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import time
+import json
+import sqlalchemy as sa
+
+# value of PointsManager.HALFLIFE at the time of this migration
+HALFLIFE = 3600*24*30
+
+def upgrade(migrate_engine):
+    metadata = sa.MetaData()
+    metadata.bind = migrate_engine
+
+    sa.Table('users', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('display_name', sa.Text, nullable=False),
+    )
+
+    points = sa.Table('points', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id')),
+        sa.Column('when', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('comments', sa.Text, nullable=False),
+    )
+
+    state = sa.Table('state', metadata,
+        sa.Column('name', sa.String(256), primary_key=True),
+        sa.Column('value', sa.Text, nullable=False),
+    )
+
+    decayed_totals = sa.Table('decayed_totals', metadata,
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id'),
+                    primary_key=True, autoincrement=False),
+        sa.Column('score', sa.Float, nullable=False),
+    )
+    decayed_totals.create()
+
+    sa.Index('decayed_totals_score', decayed_totals.c.score).create()
+
+    # populate from the existing points, using the current time as the epoch
+    epoch = int(time.time())
+    scores = {}
+    res = migrate_engine.execute(sa.select(
+        [ points.c.userid, points.c.when, points.c.points ],
+        points.c.userid != None))
+    for row in res:
+        scores[row.userid] = scores.get(row.userid, 0) + \
+                row.points * 2.0 ** ((row.when - epoch) / float(HALFLIFE))
+    if scores:
+        migrate_engine.execute(decayed_totals.insert(), [
+            dict(userid=userid, score=score)
+            for userid, score in scores.iteritems() ])
+
+    migrate_engine.execute(state.insert(),
+            name='points.decay_epoch',
+            value=json.dumps(epoch))
@@ -0,0 +1,65 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+
+DAY = 3600*24
+
+def upgrade(migrate_engine):
+    metadata = sa.MetaData()
+    metadata.bind = migrate_engine
+
+    sa.Table('users', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('display_name', sa.Text, nullable=False),
+    )
+
+    points = sa.Table('points', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id')),
+        sa.Column('when', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('comments', sa.Text, nullable=False),
+    )
+
+    points_daily = sa.Table('points_daily', metadata,
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id'),
+                    nullable=False),
+        sa.Column('day', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('count', sa.Integer, nullable=False),
+    )
+    points_daily.create()
+
+    sa.Index('points_daily_userid_day',
+            points_daily.c.userid,
+            points_daily.c.day,
+            unique=True).create()
+    sa.Index('points_daily_day', points_daily.c.day).create()
+
+    # populate from the existing points; 'when' may hold fractional seconds,
+    # so the days are computed here rather than in SQL
+    daily = {}
+    res = migrate_engine.execute(sa.select(
+        [ points.c.userid, points.c.when, points.c.points ],
+        points.c.userid != None))
+    for row in res:
+        key = (row.userid, int(row.when // DAY))
+        total, count = daily.get(key, (0, 0))
+        daily[key] = (total + row.points, count + 1)
+    if daily:
+        migrate_engine.execute(points_daily.insert(), [
+            dict(userid=userid, day=day, points=total, count=count)
+            for (userid, day), (total, count) in daily.iteritems() ])
@@ -0,0 +1,38 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+
+def upgrade(migrate_engine):
+    metadata = sa.MetaData()
+    metadata.bind = migrate_engine
+
+    sa.Table('rebuild_user_totals', metadata,
+        sa.Column('userid', sa.Integer, nullable=False),
+        sa.Column('mode', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+    ).create()
+
+    sa.Table('rebuild_decayed_totals', metadata,
+        sa.Column('userid', sa.Integer, nullable=False),
+        sa.Column('score', sa.Float, nullable=False),
+    ).create()
+
+    sa.Table('rebuild_points_daily', metadata,
+        sa.Column('userid', sa.Integer, nullable=False),
+        sa.Column('day', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('count', sa.Integer, nullable=False),
+    ).create()
@@ -0,0 +1,101 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+import migrate.changeset
+_hush_pyflakes = migrate.changeset
+
+def upgrade(migrate_engine):
+    metadata = sa.MetaData()
+    metadata.bind = migrate_engine
+
+    sa.Table('users', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('display_name', sa.Text, nullable=False),
+    )
+
+    # record where points came from, in the points table and the archive
+    for name in [ 'points', 'points_archive' ]:
+        tbl = sa.Table(name, metadata,
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('userid', sa.Integer, sa.ForeignKey('users.id')),
+            sa.Column('when', sa.Integer, nullable=False),
+            sa.Column('points', sa.Integer, nullable=False),
+            sa.Column('comments', sa.Text, nullable=False),
+        )
+        for colname in [ 'source', 'repo', 'event_type' ]:
+            sa.Column(colname, sa.String(256)).create(tbl)
+    points = metadata.tables['points']
+    sa.Index('points_source_when', points.c.source, points.c.when).create()
+    sa.Index('points_repo_when', points.c.repo, points.c.when).create()
+    sa.Index('points_event_type_when',
+             points.c.event_type, points.c.when).create()
+
+    # the totals and rollups are kept for each scope as well as globally (the
+    # empty scope); existing rows are all global
+    user_totals = sa.Table('user_totals', metadata,
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id'),
+                    nullable=False),
+        sa.Column('mode', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+    )
+    points_daily = sa.Table('points_daily', metadata,
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id'),
+                    nullable=False),
+        sa.Column('day', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('count', sa.Integer, nullable=False),
+    )
+    rebuild_user_totals = sa.Table('rebuild_user_totals', metadata,
+        sa.Column('userid', sa.Integer, nullable=False),
+        sa.Column('mode', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+    )
+    rebuild_points_daily = sa.Table('rebuild_points_daily', metadata,
+        sa.Column('userid', sa.Integer, nullable=False),
+        sa.Column('day', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('count', sa.Integer, nullable=False),
+    )
+    for tbl in [ user_totals, points_daily,
+                 rebuild_user_totals, rebuild_points_daily ]:
+        sa.Column('scope', sa.String(256), nullable=False,
+                  server_default='').create(tbl)
+
+    sa.Index('user_totals_userid_mode',
+            user_totals.c.userid, user_totals.c.mode).drop()
+    sa.Index('user_totals_mode_points',
+            user_totals.c.mode, user_totals.c.points).drop()
+    sa.Index('user_totals_userid_mode_scope',
+            user_totals.c.userid,
+            user_totals.c.mode,
+            user_totals.c.scope,
+            unique=True).create()
+    sa.Index('user_totals_scope_mode_points',
+            user_totals.c.scope,
+            user_totals.c.mode,
+            user_totals.c.points).create()
+
+    sa.Index('points_daily_userid_day',
+            points_daily.c.userid, points_daily.c.day).drop()
+    sa.Index('points_daily_day', points_daily.c.day).drop()
+    sa.Index('points_daily_userid_day_scope',
+            points_daily.c.userid,
+            points_daily.c.day,
+            points_daily.c.scope,
+            unique=True).create()
+    sa.Index('points_daily_scope_day',
+            points_daily.c.scope,
+            points_daily.c.day).create()
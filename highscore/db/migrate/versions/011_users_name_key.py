@@ -0,0 +1,45 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+import migrate.changeset
+_hush_pyflakes = migrate.changeset
+
+def upgrade(migrate_engine):
+    metadata = sa.MetaData()
+    metadata.bind = migrate_engine
+
+    users = sa.Table('users', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('display_name', sa.Text, nullable=False),
+    )
+
+    # a normalized copy of display_name, for searching by prefix; this
+    # matches UsersManager.nameKey
+    sa.Column('name_key', sa.String(256), nullable=False,
+              server_default='').create(users)
+
+    def nameKey(display_name):
+        if isinstance(display_name, str):
+            display_name = display_name.decode('utf-8', 'replace')
+        return u' '.join(display_name.lower().split())[:256]
+
+    rows = migrate_engine.execute(sa.select(
+        [ users.c.id, users.c.display_name ])).fetchall()
+    for row in rows:
+        migrate_engine.execute(users.update(users.c.id == row.id),
+                               name_key=nameKey(row.display_name))
+
+    sa.Index('users_name_key', users.c.name_key).create()
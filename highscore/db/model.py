@@ -39,7 +39,11 @@ class Model(object):
     users = sa.Table('users', metadata,
         sa.Column('id', sa.Integer, primary_key=True),
         sa.Column('display_name', sa.Text, nullable=False),
+        # display_name, normalized by UsersManager.nameKey for searching
+        sa.Column('name_key', sa.String(256), nullable=False,
+                  server_default=''),
     )
+    sa.Index('users_name_key', users.c.name_key)
 
     user_attr_types = sa.Table('user_attr_types', metadata,
         sa.Column('id', sa.Integer, primary_key=True),
@@ -63,8 +67,102 @@ class Model(object):
         sa.Column('when', sa.Integer, nullable=False), # epoch time
         sa.Column('points', sa.Integer, nullable=False),
         sa.Column('comments', sa.Text, nullable=False),
+        # where the points came from, e.g., 'github', 'buildbot/buildbot' and
+        # 'push'; any of these may be NULL
+        sa.Column('source', sa.String(256)),
+        sa.Column('repo', sa.String(256)),
+        sa.Column('event_type', sa.String(256)),
+    )
+    sa.Index('points_userid_when', points.c.userid, points.c.when)
+    sa.Index('points_when', points.c.when)
+    sa.Index('points_source_when', points.c.source, points.c.when)
+    sa.Index('points_repo_when', points.c.repo, points.c.when)
+    sa.Index('points_event_type_when', points.c.event_type, points.c.when)
+
+    # points moved out of the points table by the maintenance service; see
+    # highscore.db.maintenance
+    points_archive = sa.Table('points_archive', metadata,
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id')),
+        sa.Column('when', sa.Integer, nullable=False), # epoch time
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('comments', sa.Text, nullable=False),
+        sa.Column('source', sa.String(256)),
+        sa.Column('repo', sa.String(256)),
+        sa.Column('event_type', sa.String(256)),
+    )
+    sa.Index('points_archive_userid_when', points_archive.c.userid,
+             points_archive.c.when)
+
+    # per-user totals for each leaderboard mode and scope, maintained by
+    # addPoints; the empty scope is the global leaderboard.  See
+    # highscore.db.aggregates
+    user_totals = sa.Table('user_totals', metadata,
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id'),
+                    nullable=False),
+        sa.Column('mode', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('scope', sa.String(256), nullable=False, server_default=''),
+    )
+    sa.Index('user_totals_userid_mode_scope',
+            user_totals.c.userid,
+            user_totals.c.mode,
+            user_totals.c.scope,
+            unique=True)
+    sa.Index('user_totals_scope_mode_points',
+            user_totals.c.scope,
+            user_totals.c.mode,
+            user_totals.c.points)
+
+    # per-user sum(points * 2^((when - epoch) / HALFLIFE)), where the epoch is
+    # kept in the state table; see highscore.db.aggregates
+    decayed_totals = sa.Table('decayed_totals', metadata,
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id'),
+                    primary_key=True, autoincrement=False),
+        sa.Column('score', sa.Float, nullable=False),
+    )
+    sa.Index('decayed_totals_score', decayed_totals.c.score)
+
+    # per-user sums of points for each UTC day and scope, maintained by
+    # addPoints; raw points that have been compacted are only recorded here
+    points_daily = sa.Table('points_daily', metadata,
+        sa.Column('userid', sa.Integer, sa.ForeignKey('users.id'),
+                    nullable=False),
+        sa.Column('day', sa.Integer, nullable=False), # days since the epoch
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('count', sa.Integer, nullable=False),
+        sa.Column('scope', sa.String(256), nullable=False, server_default=''),
+    )
+    sa.Index('points_daily_userid_day_scope',
+            points_daily.c.userid,
+            points_daily.c.day,
+            points_daily.c.scope,
+            unique=True)
+    sa.Index('points_daily_scope_day',
+            points_daily.c.scope,
+            points_daily.c.day)
+
+    # staging tables for parallel rebuilds of the aggregates above; see
+    # Aggregates.thd_planRebuild
+    rebuild_user_totals = sa.Table('rebuild_user_totals', metadata,
+        sa.Column('userid', sa.Integer, nullable=False),
+        sa.Column('mode', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('scope', sa.String(256), nullable=False, server_default=''),
+    )
+
+    rebuild_decayed_totals = sa.Table('rebuild_decayed_totals', metadata,
+        sa.Column('userid', sa.Integer, nullable=False),
+        sa.Column('score', sa.Float, nullable=False),
+    )
+
+    rebuild_points_daily = sa.Table('rebuild_points_daily', metadata,
+        sa.Column('userid', sa.Integer, nullable=False),
+        sa.Column('day', sa.Integer, nullable=False),
+        sa.Column('points', sa.Integer, nullable=False),
+        sa.Column('count', sa.Integer, nullable=False),
+        sa.Column('scope', sa.String(256), nullable=False, server_default=''),
     )
-    sa.Index('points_userid', points.c.userid)
 
     # storage for arbitrary small state
     state = sa.Table('state', metadata,
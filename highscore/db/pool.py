@@ -13,13 +13,17 @@
 #
 # Copyright Buildbot Team Members
 
+import sys
 import time
 import shutil
 import os
+import threading
 import sqlalchemy as sa
 import tempfile
-from twisted.internet import reactor, threads
-from twisted.python import threadpool, log
+import multiprocessing
+from twisted.internet import reactor, threads, defer, task
+from twisted.python import threadpool, log, failure
+from highscore.util.histogram import RollingHistogram
 
 class DBThreadPool(threadpool.ThreadPool):
 
@@ -30,17 +34,80 @@ class DBThreadPool(threadpool.ThreadPool):
     # by querying the sqlite_master table.  We currently assume all versions of
     # SQLite have this bug, although it has only been observed in 3.4.2.  A
     # dynamic check for this bug would be more appropriate.  This is documented
-    # in bug #1810.
+    # in bug #1810.  Since pool threads keep their connections, the cache is
+    # only flushed when a query fails with "no such table".
     __broken_sqlite = False
 
-    def __init__(self, engine, verbose=False):
-        pool_size = 5
+    # the weight of each new observation in the average queue wait
+    QUEUE_WAIT_WEIGHT = 0.1
+
+    def __init__(self, engine, verbose=False, pool_size=None,
+                 max_pool_size=None, grow_wait=None, read_pool_size=None,
+                 group_commit_window=None, group_commit_max=100,
+                 slow_query_time=None, retry_deadline=None):
+        # the pool starts with pool_size threads, defaulting to the size the
+        # engine strategy determined suits the database.  If max_pool_size is
+        # larger, a thread is added whenever the average time that queries
+        # wait for a thread exceeds grow_wait seconds, up to max_pool_size.
+        if pool_size is None:
+            pool_size = getattr(engine, 'optimal_thread_pool_size', None) or 5
+        self.maxPoolSize = max(max_pool_size or pool_size, pool_size)
+        # SQLite has a single write lock, and do relies on running writes one
+        # at a time, in order, so never use more than one thread for it
+        if engine.dialect.name == 'sqlite' and self.maxPoolSize > 1:
+            log.msg("WARNING: SQLite databases use a single writer thread; "
+                    "ignoring pool_size %d and max_pool_size %d"
+                    % (pool_size, self.maxPoolSize))
+            pool_size = self.maxPoolSize = 1
+        self.growWait = grow_wait
+        self.queueWait = 0.0
+        self._growing = False
 
         threadpool.ThreadPool.__init__(self,
                         minthreads=1,
                         maxthreads=pool_size,
                         name='DBThreadPool')
+        log.msg("using %d database threads%s" % (pool_size,
+                ", growing to %d" % self.maxPoolSize
+                if self.maxPoolSize > pool_size and grow_wait else ''))
         self.engine = engine
+
+        # SQLite in WAL mode can run any number of readers alongside its
+        # single writer, so do_read uses a separate pool of read_pool_size
+        # (by default, one per CPU) threads.  Otherwise, reads share this
+        # pool with writes.
+        self.readers = self
+        if getattr(engine, 'wal_mode', False):
+            read_pool_size = read_pool_size or multiprocessing.cpu_count()
+            self.readers = threadpool.ThreadPool(minthreads=1,
+                        maxthreads=read_pool_size,
+                        name='DBThreadPool-readers')
+            log.msg("using %d database reader threads" % (read_pool_size,))
+
+        # callables given to do_grouped within group_commit_window seconds of
+        # each other, up to group_commit_max of them, share a transaction
+        self.groupCommitWindow = group_commit_window
+        self.groupCommitMax = group_commit_max
+        self._group = []
+        self._groupTimer = None
+
+        # per-query statistics, keyed by query name; see getStats.  Queries
+        # running for slow_query_time seconds or more are logged.
+        self.slowQueryTime = slow_query_time
+        self._queryStats = {}
+        self._statsLock = threading.Lock()
+
+        # queries that hit retryable errors are retried until retry_deadline
+        # seconds after they were queued; a query still waiting for a thread
+        # at that point is failed without being run
+        self.retryDeadline = retry_deadline or self.MAX_OPERATIONALERROR_TIME
+
+        # each pool thread keeps a connection open between queries; see
+        # _thd_connection
+        self._connections = threading.local()
+        self._openConnections = []
+        self._connectionsLock = threading.Lock()
+
         if engine.dialect.name == 'sqlite':
             brkn = self.__broken_sqlite = self.detect_bug1810()
             if brkn:
@@ -51,13 +118,19 @@ class DBThreadPool(threadpool.ThreadPool):
         self._start_evt = None
         if not self.running:
             self.start()
+            if self.readers is not self:
+                self.readers.start()
             self._stop_evt = reactor.addSystemEventTrigger(
                     'during', 'shutdown', self._stop)
             self.running = True
 
     def _stop(self):
         self._stop_evt = None
+        self._flushGroup()
         self.stop()
+        if self.readers is not self:
+            self.readers.stop()
+        self._closeConnections()
         self.engine.dispose()
         self.running = False
 
@@ -70,68 +143,369 @@ class DBThreadPool(threadpool.ThreadPool):
         reactor.removeSystemEventTrigger(self._stop_evt)
         self._stop()
 
-    # Try about 170 times over the space of a day, with the last few tries
-    # being about an hour apart.  This is designed to span a reasonable amount
-    # of time for repairing a broken database server, while still failing
-    # actual problematic queries eventually
+    # By default, try about 40 times over the space of two minutes, with the
+    # last few tries being about 7 seconds apart.  That rides out a locked
+    # database or a restarting server, while the callers, such as an IRC
+    # user waiting for a reply, are not left hanging for long.
     BACKOFF_START = 1.0
     BACKOFF_MULT = 1.05
-    MAX_OPERATIONALERROR_TIME = 3600*24 # one day
-    def __thd(self, with_engine, callable, args, kwargs):
-        # try to call callable(arg, *args, **kwargs) repeatedly until no
-        # OperationalErrors occur, where arg is either the engine (with_engine)
-        # or a connection (not with_engine)
+    MAX_OPERATIONALERROR_TIME = 120 # two minutes
+    @defer.inlineCallbacks
+    def __run(self, pool, with_engine, name, callable, args, kwargs):
+        # run callable in one of pool's threads with __thd, retrying after
+        # retryable OperationalErrors.  The backoff between attempts happens
+        # here, in the reactor, so that the thread is free for other queries
+        # in the meantime.
+        queued = time.time()
+        deadline = queued + self.retryDeadline
+        times = dict(wait=0.0, run=0.0)
         backoff = self.BACKOFF_START
+        retries = 0
+        slept = 0.0
+        failed = True
+        try:
+            while True:
+                # a stopped pool silently drops new work, which would leave
+                # this Deferred waiting forever
+                if pool.joined:
+                    raise RuntimeError("the database thread pool has "
+                                       "stopped")
+                try:
+                    rv = yield threads.deferToThreadPool(reactor, pool,
+                            self.__thd, pool, with_engine, time.time(),
+                            deadline, times, callable, args, kwargs)
+                    break
+                except sa.exc.OperationalError, e:
+                    # see if we've retried too much
+                    if not self._isRetryable(e) \
+                            or time.time() + backoff > deadline:
+                        raise
+
+                log.msg("automatically retrying query after "
+                        "OperationalError (%ss sleep)" % backoff)
+                yield task.deferLater(reactor, backoff, lambda : None)
+                retries += 1
+                slept += backoff
+                backoff *= self.BACKOFF_MULT
+            failed = False
+        finally:
+            self._recordQuery(name, times['wait'], times['run'], retries,
+                              slept, failed)
+        defer.returnValue(rv)
+
+    def __thd(self, pool, with_engine, queued, deadline, times, callable,
+              args, kwargs):
+        # call callable(arg, *args, **kwargs), where arg is either the engine
+        # (with_engine) or a connection (not with_engine), adding the time
+        # spent waiting for this thread and running to times
         start = time.time()
-        while True:
+        times['wait'] += start - queued
+        if pool is self:
+            self._noteQueueWait(start - queued)
+        if start > deadline:
+            raise defer.TimeoutError("query waited %.1fs for a database "
+                                     "thread" % (start - queued,))
+        conn = None
+        try:
             if with_engine:
                 arg = self.engine
             else:
-                arg = self.engine.contextual_connect()
+                arg = conn = self._thd_connection()
 
-            if self.__broken_sqlite: # see bug #1810
-                arg.execute("select * from sqlite_master")
             try:
                 try:
                     rv = callable(arg, *args, **kwargs)
-                    assert not isinstance(rv, sa.engine.ResultProxy), \
-                            "do not return ResultProxy objects!"
                 except sa.exc.OperationalError, e:
-                    text = e.orig.args[0]
-                    if not isinstance(text, basestring):
+                    if not self.__broken_sqlite \
+                            or 'no such table' not in str(e):
                         raise
-                    if "Lost connection" in text \
-                        or "database is locked" in text:
+                    # see bug #1810
+                    arg.execute("select * from sqlite_master")
+                    rv = callable(arg, *args, **kwargs)
+                assert not isinstance(rv, sa.engine.ResultProxy), \
+                        "do not return ResultProxy objects!"
+            except:
+                if conn is not None:
+                    self._thd_checkConnection(conn)
+                raise
+            # the connection outlives this query, so don't let it carry an
+            # unfinished transaction into the next one.  That includes
+            # transactions the DBAPI began implicitly, e.g., for a SELECT with
+            # MySQLdb, which would otherwise pin a stale snapshot; returning
+            # the connection to the engine's pool used to roll these back.
+            if conn is not None:
+                if conn.in_transaction():
+                    log.msg("rolling back a transaction left open by a "
+                            "query")
+                    conn.close()
+                else:
+                    conn.connection.rollback()
+        finally:
+            times['run'] += time.time() - start
+        return rv
 
-                        # see if we've retried too much
-                        elapsed = time.time() - start
-                        if elapsed > self.MAX_OPERATIONALERROR_TIME:
-                            raise
+    def _thd_connection(self):
+        # return this thread's connection, opening it if necessary.  Keeping
+        # it saves connecting for every query, and means per-connection setup
+        # such as SQLite's pragmas happens once per thread.
+        conn = getattr(self._connections, 'conn', None)
+        if conn is None or conn.closed:
+            conn = self._connections.conn = self.engine.contextual_connect()
+            with self._connectionsLock:
+                self._openConnections = [ c for c in self._openConnections
+                                          if not c.closed ] + [ conn ]
+        return conn
 
-                        log.msg("automatically retrying query after "
-                                "OperationalError (%ss sleep)" % backoff)
+    def _thd_checkConnection(self, conn):
+        # called after a query on conn fails or leaves a transaction open.
+        # Keep the connection only if it is idle and still works; otherwise
+        # close it, rolling back, and the next query in this thread (such as
+        # a retry) opens a new one.
+        try:
+            if not conn.in_transaction():
+                conn.execute("select 1").scalar()
+                return
+        except Exception:
+            log.msg("discarding a database connection that failed a health "
+                    "check")
+            conn.invalidate()
+        conn.close()
 
-                        # sleep (remember, we're in a thread..)
-                        time.sleep(backoff)
-                        backoff *= self.BACKOFF_MULT
+    def _closeConnections(self):
+        # close the connections kept by the (now stopped) pool threads
+        with self._connectionsLock:
+            conns, self._openConnections = self._openConnections, []
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
 
-                        # and re-try
-                        continue
-                    else:
-                        raise
-            finally:
-                if not with_engine:
-                    arg.close()
-            break
-        return rv
+    def _isRetryable(self, e):
+        # whether an OperationalError is worth retrying
+        text = e.orig.args[0]
+        if not isinstance(text, basestring):
+            return False
+        # (a connection that has gone away is replaced before the retry; see
+        # _thd_checkConnection)
+        return ("Lost connection" in text or "database is locked" in text or
+                "server has gone away" in text)
 
     def do(self, callable, *args, **kwargs):
-        return threads.deferToThreadPool(reactor, self,
-                self.__thd, False, callable, args, kwargs)
+        # run callable(conn, *args, **kwargs) in a thread, returning a
+        # Deferred.  Use this (or its alias do_write) for anything that may
+        # write; with SQLite, writes run one at a time, in order.
+        return self.__run(self, False, self._queryName(callable), callable,
+                          args, kwargs)
+
+    do_write = do
+
+    def do_read(self, callable, *args, **kwargs):
+        # like do, for callables that only read; these may run concurrently
+        # with writes and with each other
+        return self.__run(self.readers, False, self._queryName(callable),
+                          callable, args, kwargs)
 
     def do_with_engine(self, callable, *args, **kwargs):
-        return threads.deferToThreadPool(reactor, self,
-                self.__thd, True, callable, args, kwargs)
+        return self.__run(self, True, self._queryName(callable), callable,
+                          args, kwargs)
+
+    def do_grouped(self, callable, *args, **kwargs):
+        # like do, but if group commit is enabled, run the callable in a
+        # transaction shared with others queued around the same time, saving
+        # a commit (and, for SQLite, an fsync) for each.  The Deferred fires
+        # once that transaction has committed.  Each callable runs in a
+        # savepoint, so a failure only affects its own changes; callables may
+        # begin and commit their own transactions, which become part of the
+        # shared one.  A callable that rolls back its own transaction is run
+        # again on its own, as it would be by do.  The callable may be run
+        # more than once, so it must not update anything outside the
+        # database; return such updates and apply them once the Deferred
+        # fires.  Don't use this for statements that cannot run in a
+        # transaction, such as VACUUM.
+        if not self.groupCommitWindow:
+            return self.__run(self, False, self._queryName(callable),
+                              callable, args, kwargs)
+        d = defer.Deferred()
+        self._group.append((callable, args, kwargs,
+                            self._queryName(callable), time.time(), d))
+        if len(self._group) >= self.groupCommitMax:
+            self._flushGroup()
+        elif not self._groupTimer:
+            self._groupTimer = reactor.callLater(self.groupCommitWindow,
+                                                 self._flushGroup)
+        return d
+
+    def _flushGroup(self):
+        if self._groupTimer:
+            if self._groupTimer.active():
+                self._groupTimer.cancel()
+            self._groupTimer = None
+        group, self._group = self._group, []
+        if not group:
+            return
+
+        d = self.__run(self, False, 'db.group_commit', self._thd_runGroup,
+                       ([ item[:-1] for item in group ],), {})
+        @d.addCallback
+        def deliver(results):
+            for item, (ok, result) in zip(group, results):
+                if ok is None:
+                    callable, args, kwargs, name = item[:4]
+                    self.__run(self, False, name, callable, args,
+                               kwargs).chainDeferred(item[-1])
+                elif ok:
+                    item[-1].callback(result)
+                else:
+                    item[-1].errback(result)
+        @d.addErrback
+        def failed(f):
+            for item in group:
+                item[-1].errback(f)
+
+    def _thd_runGroup(self, conn, group):
+        # run each (callable, args, kwargs, name, queued) in group in a
+        # savepoint of a single transaction, returning a list of
+        # (True, result) or (False, failure).  Once a callable has rolled
+        # back its own transaction, its later statements would not be in its
+        # savepoint, so the whole transaction is rolled back, the rest are
+        # run again without it, and its entry is (None, None), for
+        # _flushGroup to run it alone.  Retryable errors roll everything back
+        # and are left to __run to retry.  The statistics for each member are
+        # recorded once the transaction commits, for its last run.
+        sqlite = self.engine.dialect.name == 'sqlite'
+        if sqlite:
+            # pysqlite's own transaction handling breaks savepoints, so turn
+            # it off and begin the transaction explicitly
+            dbapi_conn = conn.connection.connection
+            isolation_level = dbapi_conn.isolation_level
+            dbapi_conn.isolation_level = None
+
+        try:
+            failures = {}
+            alone = set()
+            timings = {}
+            while True:
+                if sqlite:
+                    conn.execute("BEGIN")
+                transaction = conn.begin()
+                results = {}
+                try:
+                    for i, (callable, args, kwargs, name, queued) \
+                            in enumerate(group):
+                        if i in failures or i in alone:
+                            continue
+                        savepoint = conn.begin_nested()
+                        started = time.time()
+                        try:
+                            rv = callable(conn, *args, **kwargs)
+                            assert not isinstance(rv,
+                                    sa.engine.ResultProxy), \
+                                    "do not return ResultProxy objects!"
+                            results[i] = rv
+                        except sa.exc.OperationalError, e:
+                            if self._isRetryable(e):
+                                raise
+                            failures[i] = failure.Failure()
+                        except:
+                            failures[i] = failure.Failure()
+                        if not savepoint.is_active \
+                                or not transaction.is_active:
+                            failures.pop(i, None)
+                            alone.add(i)
+                            break
+                        timings[i] = (name, started - queued,
+                                      time.time() - started)
+                        if i in failures:
+                            savepoint.rollback()
+                        else:
+                            savepoint.commit()
+                    else:
+                        transaction.commit()
+                        for i, (name, wait, run) in timings.iteritems():
+                            self._recordQuery(name, wait, run, 0, 0.0,
+                                              i in failures)
+                        return [ (None, None) if i in alone
+                                 else (False, failures[i]) if i in failures
+                                 else (True, results[i])
+                                 for i in range(len(group)) ]
+                    if transaction.is_active:
+                        transaction.rollback()
+                except:
+                    if transaction.is_active:
+                        transaction.rollback()
+                    raise
+                # the transaction was rolled back; start again
+        finally:
+            if sqlite:
+                dbapi_conn.isolation_level = isolation_level
+
+    def _queryName(self, callable):
+        # a name for statistics: the callable's queryName attribute, if it
+        # has one, or else the function that called do (or do_read, etc.),
+        # e.g., 'managers.points._queryHighscores'
+        name = getattr(callable, 'queryName', None)
+        if name:
+            return name
+        frame = sys._getframe(2)
+        module = frame.f_globals.get('__name__', '?')
+        if module.startswith('highscore.'):
+            module = module[len('highscore.'):]
+        return '%s.%s' % (module, frame.f_code.co_name)
+
+    def _recordQuery(self, name, wait, run, retries, slept, failed):
+        # called when a query finishes: by __run, in the reactor, or for the
+        # members of a group, by _thd_runGroup in a pool thread
+        with self._statsLock:
+            stats = self._queryStats.get(name)
+            if stats is None:
+                stats = self._queryStats[name] = dict(calls=0, errors=0,
+                        retries=0, retry_sleep=0.0, wait=RollingHistogram(),
+                        run=RollingHistogram())
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['retries'] += retries
+            stats['retry_sleep'] += slept
+            stats['wait'].add(wait)
+            stats['run'].add(run)
+        if self.slowQueryTime is not None and run >= self.slowQueryTime:
+            log.msg("slow query %s: ran for %.3fs after waiting %.3fs, "
+                    "with %d retries" % (name, run, wait, retries))
+
+    def getStats(self):
+        # return the statistics for each query name: counts of calls, errors
+        # and retries, the total time spent sleeping before retries, and
+        # histograms of the time spent waiting for a thread and running
+        # (without retry sleeps) over the last five minutes
+        with self._statsLock:
+            queries = dict((name, dict(stats, wait=stats['wait'].getStats(),
+                                       run=stats['run'].getStats()))
+                           for name, stats in self._queryStats.iteritems())
+            queueWait = self.queueWait
+        return dict(queries=queries, threads=self.max,
+                    reader_threads=self.readers.max,
+                    queue_wait=queueWait)
+
+    def _noteQueueWait(self, wait):
+        # called in a pool thread with the time a query waited for it; other
+        # threads may be doing the same
+        with self._statsLock:
+            self.queueWait += (wait - self.queueWait) * self.QUEUE_WAIT_WEIGHT
+            if self.growWait and self.queueWait > self.growWait \
+                    and self.max < self.maxPoolSize and not self._growing:
+                self._growing = True
+                reactor.callFromThread(self._grow)
+
+    def _grow(self):
+        with self._statsLock:
+            self._growing = False
+            if self.max >= self.maxPoolSize:
+                return
+            # measure again with the new size
+            queueWait, self.queueWait = self.queueWait, 0.0
+        log.msg("queries waited %.3fs on average for a database thread; "
+                "growing the pool to %d threads" % (queueWait, self.max + 1))
+        self.adjustPoolsize(maxthreads=self.max + 1)
 
     def detect_bug1810(self):
         # detect buggy SQLite implementations; call only for a known-sqlite
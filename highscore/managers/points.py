@@ -15,43 +15,224 @@
 
 import time
 import sqlalchemy as sa
-from twisted.internet import defer
-from twisted.application import service
+from twisted.internet import defer, reactor
+from twisted.python import log, failure
+from twisted.application import service, internet
 
 from highscore.const import ConstMaster as const
+from highscore.db import aggregates
+from highscore.util import ranking, windows
 
 class PointsManager(service.MultiService):
 
     HALFLIFE = 3600*24*30 # points lose half their value after a month
     MAX_AGE = HALFLIFE * 4 # points disappear after losing 15/16th of their value
+    # the monthly totals may lag by up to this many seconds
+    EXPIRE_INTERVAL = 60
+
+    RANKED_MODES = (const.MONTHLY_MODE, const.LONGTERM_MODE,
+                    const.DECAYED_MODE)
+
+    # boards whose changes of leader are announced, and how to name them
+    LEADER_BOARDS = {
+        const.MONTHLY_MODE : 'monthly',
+        const.LONGTERM_MODE : 'career',
+    }
 
     def __init__(self, highscore, config):
         service.MultiService.__init__(self)
         self.setName('highscore.points')
         self.highscore = highscore
         self.config = config
+        self.mq_consumers = []
+
+        # optional write-behind buffering of addPoints; bufferDelay is the
+        # longest a point will wait to be written
+        self.bufferDelay = config.points.get('buffer_delay')
+        self.bufferRows = config.points.get('buffer_rows', 100)
+        self._buffer = []
+        self._flushTimer = None
+        self._writeLock = defer.DeferredLock()
+
+        self.aggregates = aggregates.Aggregates(highscore.db.model,
+                                                self.HALFLIFE)
+        # serializes expiry of the monthly totals and seeding of the ranks
+        self._totalsLock = defer.DeferredLock()
+        self._lastExpiry = None
+
+        # in-memory rank indexes, seeded from the aggregates and then kept up
+        # to date from points.add.* messages with a pointsid greater than
+        # _seedPointsId.  Decayed scores are kept relative to _decayEpoch.
+        self.ranks = dict((mode, ranking.RankIndex())
+                          for mode in self.RANKED_MODES)
+        self._ranksSeeded = False
+        self._seedWaiters = None
+        self._seedPointsId = 0
+        self._decayEpoch = None
+        self._pendingAdds = None
+        # the generation of the aggregates the indexes were seeded from; see
+        # checkGeneration
+        self._seedGeneration = None
+
+        # points.rank_change.* messages are sent when a user overtakes, or is
+        # overtaken by, someone in the top rankChangeTop of a ranked mode.
+        # Display names for them are remembered from the seed and from
+        # points.add.* messages, so that no queries are needed.
+        self.rankChangeTop = config.points.get('rank_change_top', 10)
+        self._displayNames = {}
+
+        # cache of getHighscores results, keyed by its arguments.  The cache is
+        # emptied whenever the scores change, and entries also expire after
+        # cacheTTL seconds so that rolling windows slide.  Concurrent misses
+        # for the same key wait for a single query in _scoresInFlight.
+        self.cacheTTL = config.points.get('cache_ttl', self.EXPIRE_INTERVAL)
+        self._scoresCache = {}
+        self._scoresInFlight = {}
+        self._scoresGeneration = 0
+
+        expirer = internet.TimerService(self.EXPIRE_INTERVAL,
+                                        self._expireMonthlyTimer)
+        expirer.setServiceParent(self)
+
+        # optional compaction of raw points older than compactHorizon seconds
+        # (e.g., MAX_AGE) into the daily rollups, compactBatch rows per
+        # transaction
+        self.compactHorizon = config.points.get('compact_horizon')
+        self.compactBatch = config.points.get('compact_batch', 1000)
+        # serializes compactions, which may come from the timer here or from
+        # the database maintenance service
+        self._compactLock = defer.DeferredLock()
+
+        # points moved per transaction by mergePoints
+        self.mergeBatch = config.points.get('merge_batch', 1000)
+        if self.compactHorizon:
+            compactor = internet.TimerService(
+                    config.points.get('compact_interval', 3600),
+                    self._compactPointsTimer)
+            compactor.setServiceParent(self)
+
+    def startService(self):
+        service.MultiService.startService(self)
+        self.mq_consumers.append(self.highscore.mq.consume(
+                self._pointsAdded, 'points.add.*'))
+        d = self.seedRanks()
+        d.addErrback(log.err, 'while seeding rank indexes')
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        # write out any buffered points before stopping
+        yield self.flushPoints()
+        yield self._writeLock.run(lambda : None)
+
+        consumers = self.mq_consumers
+        while consumers:
+            cons = consumers.pop()
+            cons.stop_consuming()
+        yield service.MultiService.stopService(self)
+
+    def addPoints(self, userid, points, comments, source=None, repo=None,
+                  event_type=None):
+        # source, repo and event_type optionally record where the points came
+        # from, e.g., 'github', 'buildbot/buildbot' and 'push'
+        row = dict(userid=userid, when=time.time(), points=points,
+                   comments=comments, source=source, repo=repo,
+                   event_type=event_type)
+        if self.bufferDelay is None:
+            return self._writePoints([ (row, None) ])
+
+        # add the points to the write-behind buffer, and flush it once it is
+        # full or bufferDelay has passed
+        d = defer.Deferred()
+        self._buffer.append((row, d))
+        if len(self._buffer) >= self.bufferRows:
+            self.flushPoints()
+        elif not self._flushTimer:
+            self._flushTimer = reactor.callLater(self.bufferDelay,
+                                                 self.flushPoints)
+        return d
+
+    def flushPoints(self):
+        if self._flushTimer:
+            if self._flushTimer.active():
+                self._flushTimer.cancel()
+            self._flushTimer = None
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return defer.succeed(None)
+        return self._writePoints(batch)
 
     @defer.inlineCallbacks
-    def addPoints(self, userid, points, comments):
+    def _writePoints(self, batch):
+        # write a batch of (row, deferred) pairs in a single transaction, then
+        # send the messages for them in order.  Batches are serialized so that
+        # their messages are not reordered.
         def thd(conn):
-            tbl = self.highscore.db.model.points
-            timeAdd = time.time()
-            r = conn.execute(tbl.insert(), dict(
-                userid=userid,
-                when=timeAdd,
-                points=points,
-                comments=comments))
-            id = r.inserted_primary_key[0]
-                  
-        yield self.highscore.db.pool.do(thd)
+            pointsTbl = self.highscore.db.model.points
+            rows = [ row for row, _ in batch ]
+
+            transaction = conn.begin()
+            try:
+                # executemany does not report the new ids, and with another
+                # writer (a second bot, or a script) neither max(id) nor the
+                # ids of a multi-row insert can be relied on, so insert the
+                # rows one by one; the transaction is still committed once
+                ids = [ conn.execute(pointsTbl.insert(), row)
+                            .inserted_primary_key[0]
+                        for row in rows ]
+                self.aggregates.thd_addPoints(conn, rows)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
 
-        display_name = yield self.highscore.users.getDisplayName(userid)
+            found = users.thd_getDisplayNames(conn, missing)
+            names.update(found)
+            return found, [ dict(row, pointsid=id,
+                          display_name=names.get(row['userid'], '(unknown)'))
+                     for row, id in zip(rows, ids) ]
+
+        # most display names are cached, so only the rest are queried
+        users = self.highscore.users
+        names, missing = users.getCachedDisplayNames(
+                row['userid'] for row, _ in batch)
+        generation = users.cacheGeneration
+
+        yield self._writeLock.acquire()
+        try:
+            try:
+                found, added = yield self.highscore.db.pool.do(thd)
+            except:
+                f = failure.Failure()
+                for _, d in batch:
+                    if d:
+                        d.errback(f)
+                if batch[0][1]:
+                    return # the error has been delivered to each caller
+                raise
+
+            users.cacheDisplayNames(found, generation)
+            for info in added:
+                self._notifyPoints(info)
+        finally:
+            self._writeLock.release()
+
+        for _, d in batch:
+            if d:
+                d.callback(None)
+
+    def _notifyPoints(self, info):
+        userid = info['userid']
+        points = info['points']
+        comments = info['comments']
+        display_name = info['display_name']
 
         # notify about the points
         self.highscore.mq.produce('points.add.%d' % userid,
-                dict(pointsid=id, userid=userid,
-                        display_name=display_name, points=points,
-                        comments=comments))
+                dict(pointsid=info['pointsid'], userid=userid,
+                        when=info['when'], display_name=display_name,
+                        points=points, comments=comments,
+                        source=info['source'], repo=info['repo'],
+                        event_type=info['event_type']))
 
         # send an announcement
         if points == 0:
@@ -68,59 +249,508 @@ class PointsManager(service.MultiService):
         self.highscore.mq.produce('announce.points',
                 dict(message=msg))
 
-    def getUserPoints(self, userid):
+    def getUserPoints(self, userid, before=None, limit=None):
+        # return the user's points, newest first.  To page through them, pass
+        # the (when, pointsid) of the last row of the previous page as
+        # 'before'.
         def thd(conn):
             pointsTbl = self.highscore.db.model.points
-            now = time.time()
+
+            whereclause = (pointsTbl.c.userid == userid)
+            if before is not None:
+                beforeWhen, beforeId = before
+                whereclause &= ((pointsTbl.c.when < beforeWhen) |
+                                ((pointsTbl.c.when == beforeWhen) &
+                                 (pointsTbl.c.id < beforeId)))
 
             r = conn.execute(sa.select(
-                [ pointsTbl.c.when, pointsTbl.c.points, pointsTbl.c.comments ],
-                (pointsTbl.c.userid == userid) &
-                (pointsTbl.c.when > now - self.MAX_AGE),
-                order_by=[ pointsTbl.c.when ]))
-            def age_points(row):
-                mult = 0.5 ** ((now - row.when) / self.HALFLIFE)
-                return mult * row.points
-            return [ dict(when=row.when, points=row.points,
-                          comments=row.comments)
+                [ pointsTbl.c.id, pointsTbl.c.when, pointsTbl.c.points,
+                  pointsTbl.c.comments, pointsTbl.c.source, pointsTbl.c.repo,
+                  pointsTbl.c.event_type ],
+                whereclause,
+                order_by=[ sa.desc(pointsTbl.c.when),
+                           sa.desc(pointsTbl.c.id) ],
+                limit=limit))
+            return [ dict(pointsid=row.id, when=row.when, points=row.points,
+                          comments=row.comments, source=row.source,
+                          repo=row.repo, event_type=row.event_type)
                      for row in r ]
-        return self.highscore.db.pool.do(thd)
+        return self.highscore.db.pool.do_read(thd)
+
+    @defer.inlineCallbacks
+    def expireMonthly(self):
+        # bring the monthly totals up to date; this is serialized, and does
+        # nothing if it has run in the last EXPIRE_INTERVAL seconds
+        yield self._totalsLock.acquire()
+        try:
+            now = time.time()
+            if self._lastExpiry \
+                    and now - self._lastExpiry < self.EXPIRE_INTERVAL:
+                defer.returnValue({})
+            def thd(conn):
+                return self.aggregates.thd_expireMonthly(conn, now)
+            expired = yield self.highscore.db.pool.do(thd)
+            self._lastExpiry = now
+            if expired:
+                self.invalidateHighscores()
+
+            if self._ranksSeeded:
+                index = self.ranks[const.MONTHLY_MODE]
+                for userid, total in expired.iteritems():
+                    index.addScore(userid, -total)
+                    if index.getScore(userid) == 0:
+                        index.removeUser(userid)
+        finally:
+            self._totalsLock.release()
+        defer.returnValue(expired)
+
+    def _expireMonthlyTimer(self):
+        d = self.checkGeneration()
+        d.addCallback(lambda _ : self.expireMonthly())
+        d.addErrback(log.err, 'while expiring monthly points')
+        return d
+
+    @defer.inlineCallbacks
+    def checkGeneration(self):
+        # if another process, such as rebuild-aggregates, has replaced the
+        # aggregates, the rank indexes, decay epoch and cached leaderboards
+        # are stale, so reload them
+        if not self._ranksSeeded:
+            return
+        generation = yield self.highscore.db.pool.do_read(
+                self.aggregates.thd_getGeneration)
+        if generation != self._seedGeneration:
+            log.msg("the aggregates have been rebuilt; reseeding ranks")
+            self._lastExpiry = None
+            self.invalidateHighscores()
+            yield self.seedRanks()
+
+    @defer.inlineCallbacks
+    def compactPoints(self, horizon=None, archive=False, batch=None):
+        # remove raw points older than 'horizon' seconds (by default,
+        # compactHorizon) in batches, leaving them recorded only in the daily
+        # rollups and, if 'archive' is true, in the points_archive table;
+        # returns the number removed
+        yield self._compactLock.acquire()
+        try:
+            cutoffTime = time.time() - (horizon or self.compactHorizon)
+            batch = batch or self.compactBatch
+            def thdStart(conn):
+                return self.aggregates.thd_startCompaction(conn, cutoffTime)
+            cutoff = yield self.highscore.db.pool.do(thdStart)
+
+            def thd(conn):
+                return self.aggregates.thd_compactBatch(conn, cutoff, batch,
+                                                        archive=archive)
+            deleted = 0
+            while True:
+                count = yield self.highscore.db.pool.do(thd)
+                deleted += count
+                if count < batch:
+                    break
+        finally:
+            self._compactLock.release()
+        if deleted:
+            # windows starting in a compacted day now include all of it
+            self.invalidateHighscores()
+            log.msg("%s %d points from before %s" %
+                    ('archived' if archive else 'compacted', deleted,
+                     time.asctime(time.gmtime(cutoff))))
+        defer.returnValue(deleted)
+
+    def _compactPointsTimer(self):
+        d = self.compactPoints()
+        d.addErrback(log.err, 'while compacting points')
+        return d
 
-    def getHighscores(self, mode):
+    @defer.inlineCallbacks
+    def rebuildAggregates(self):
         def thd(conn):
-            pointsTbl = self.highscore.db.model.points
+            self.aggregates.thd_rebuild(conn, time.time())
+        yield self.highscore.db.pool.do(thd)
+        self._lastExpiry = None
+        self.invalidateHighscores()
+        yield self.seedRanks()
+
+    @defer.inlineCallbacks
+    def mergePoints(self, src, dst, batch=None):
+        # move all of src's points, archived points and aggregates to dst,
+        # 'batch' points per transaction so that writers are not blocked for
+        # long.  The aggregates are adjusted along with each batch, so the
+        # leaderboards stay consistent throughout.  Returns the number of
+        # points moved.
+        batch = batch or self.mergeBatch
+        model = self.highscore.db.model
+
+        def thd(conn):
+            pointsTbl = model.points
+            transaction = conn.begin()
+            try:
+                rows = [ dict(row) for row in conn.execute(sa.select(
+                    [ pointsTbl.c.id, pointsTbl.c.userid, pointsTbl.c.when,
+                      pointsTbl.c.points, pointsTbl.c.source,
+                      pointsTbl.c.repo, pointsTbl.c.event_type ],
+                    pointsTbl.c.userid == src,
+                    order_by=[ pointsTbl.c.id ],
+                    limit=batch)) ]
+                if rows:
+                    conn.execute(pointsTbl.update(pointsTbl.c.id.in_(
+                        [ row['id'] for row in rows ])).values(userid=dst))
+                    self.aggregates.thd_movePoints(conn, rows, dst)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            return len(rows)
+
+        def thdArchive(conn):
+            archiveTbl = model.points_archive
+            ids = [ row.id for row in conn.execute(sa.select(
+                    [ archiveTbl.c.id ], archiveTbl.c.userid == src,
+                    limit=batch)) ]
+            if ids:
+                conn.execute(archiveTbl.update(
+                    archiveTbl.c.id.in_(ids)).values(userid=dst))
+            return len(ids)
+
+        def thdAggregates(conn):
+            return self.aggregates.thd_mergeBatch(conn, src, dst, batch)
+
+        moved = 0
+        for step in thd, thdArchive, thdAggregates:
+            while True:
+                # serialize with expiry of the monthly totals, which reads
+                # the points by user
+                yield self._totalsLock.acquire()
+                try:
+                    count = yield self.highscore.db.pool.do(step)
+                finally:
+                    self._totalsLock.release()
+                if step is thd:
+                    moved += count
+                if count < batch:
+                    break
+
+        log.msg("moved %d points from user %d to user %d" % (moved, src, dst))
+        self.invalidateHighscores()
+        yield self.seedRanks()
+        defer.returnValue(moved)
+
+    # rank indexes
+
+    @defer.inlineCallbacks
+    def seedRanks(self):
+        if self._seedWaiters is not None:
+            # already seeding; just wait for it
+            d = defer.Deferred()
+            self._seedWaiters.append(d)
+            yield d
+            return
+        self._seedWaiters = []
+        self._pendingAdds = []
+
+        yield self._totalsLock.acquire()
+        try:
+            def thd(conn):
+                model = self.highscore.db.model
+                maxIdQuery = sa.select([ sa.func.max(model.points.c.id) ])
+                while True:
+                    maxId = conn.execute(maxIdQuery).scalar()
+                    totals = conn.execute(sa.select([
+                        model.user_totals.c.userid,
+                        model.user_totals.c.mode,
+                        model.user_totals.c.points ],
+                        model.user_totals.c.scope == '')).fetchall()
+                    decayed = conn.execute(sa.select([
+                        model.decayed_totals.c.userid,
+                        model.decayed_totals.c.score ])).fetchall()
+                    epoch = self.aggregates.thd_getDecayEpoch(conn,
+                                                              time.time())
+                    generation = self.aggregates.thd_getGeneration(conn)
+                    # if points were added while reading, try again, as we
+                    # can't tell whether they are included
+                    if conn.execute(maxIdQuery).scalar() == maxId:
+                        break
+                names = conn.execute(sa.select([
+                    model.users.c.id, model.users.c.display_name ],
+                    model.users.c.id.in_(sa.select(
+                        [ model.user_totals.c.userid ],
+                        model.user_totals.c.scope == '')))).fetchall()
+                return maxId or 0, totals, decayed, epoch, generation, names
+            maxId, totals, decayed, epoch, generation, names = \
+                    yield self.highscore.db.pool.do(thd)
+
+            for index in self.ranks.itervalues():
+                index.clear()
+            for row in totals:
+                if row.mode in self.ranks:
+                    self.ranks[row.mode].setScore(row.userid, row.points)
+            for row in decayed:
+                self.ranks[const.DECAYED_MODE].setScore(row.userid,
+                                                        row.score)
+            self._displayNames.update((row.id, row.display_name)
+                                      for row in names)
+            self._seedPointsId = maxId
+            self._decayEpoch = epoch
+            self._seedGeneration = generation
+            self._ranksSeeded = True
+
+            pending, self._pendingAdds = self._pendingAdds, None
+            for data in pending:
+                self._applyPointsAdded(data)
+        except:
+            self._pendingAdds = None
+            waiters, self._seedWaiters = self._seedWaiters, None
+            for d in waiters:
+                d.errback()
+            raise
+        finally:
+            self._totalsLock.release()
+
+        waiters, self._seedWaiters = self._seedWaiters, None
+        for d in waiters:
+            d.callback(None)
+
+    def _pointsAdded(self, routing_key, data):
+        self.invalidateHighscores()
+        if self._pendingAdds is not None:
+            self._pendingAdds.append(data)
+        elif self._ranksSeeded:
+            self._applyPointsAdded(data)
+
+    def _applyPointsAdded(self, data):
+        if data['pointsid'] <= self._seedPointsId:
+            return # already included in the seed
+        userid = data['userid']
+        points = data['points']
+        self._displayNames[userid] = data['display_name']
+        self._addRankedScore(const.MONTHLY_MODE, userid, points)
+        self._addRankedScore(const.LONGTERM_MODE, userid, points)
+        self._addRankedScore(const.DECAYED_MODE, userid,
+                points / self.aggregates.decay(self._decayEpoch, data['when']))
+
+    def _addRankedScore(self, mode, userid, delta):
+        # add to a user's score, and report any change of rank within the
+        # top rankChangeTop.  Only the ranks between the user's old and new
+        # positions can change, so this takes O(log n + rankChangeTop).
+        index = self.ranks[mode]
+        top = self.rankChangeTop
+        oldRank = index.getRank(userid)
+        leaders = index.getRange(1, 1)
+        index.addScore(userid, delta)
+        newRank = index.getRank(userid)
+
+        if oldRank is None:
+            oldRank = len(index) # a new user starts from the bottom
+        if newRank < oldRank and newRank <= top:
+            # the user moved up past those now just below them
+            overtook = index.getRange(newRank + 1, min(oldRank, top))
+            overtakenBy = []
+        elif newRank > oldRank and oldRank <= top:
+            # the user dropped below those now just above them
+            overtook = []
+            overtakenBy = index.getRange(oldRank, min(newRank - 1, top))
+        else:
+            return
+
+        self.highscore.mq.produce('points.rank_change.%d' % userid,
+                dict(userid=userid, display_name=self._displayName(userid),
+                     mode=mode, old_rank=oldRank, new_rank=newRank,
+                     points=self._rankedPoints(mode, index.getScore(userid)),
+                     overtook=[ uid for _, uid, _ in overtook ],
+                     overtaken_by=[ uid for _, uid, _ in overtakenBy ]))
+
+        if mode not in self.LEADER_BOARDS or not leaders:
+            return
+        oldLeader = leaders[0][1]
+        newLeader = index.getRange(1, 1)[0][1]
+        if newLeader != oldLeader:
+            msg = "%s takes the lead on the %s board from %s" % (
+                    self._displayName(newLeader), self.LEADER_BOARDS[mode],
+                    self._displayName(oldLeader))
+            self.highscore.mq.produce('announce.leader',
+                    dict(message=msg, mode=mode, userid=newLeader,
+                         previous_userid=oldLeader))
+
+    def _displayName(self, userid):
+        return self._displayNames.get(userid, '(unknown)')
+
+    def _rankedPoints(self, mode, score):
+        if mode == const.DECAYED_MODE:
+            return round(score * self.aggregates.decay(self._decayEpoch,
+                                                       time.time()), 2)
+        return score
+
+    @defer.inlineCallbacks
+    def _waitForRanks(self):
+        if not self._ranksSeeded:
+            yield self.seedRanks()
+
+    @defer.inlineCallbacks
+    def getUserRank(self, userid, mode):
+        yield self._waitForRanks()
+        index = self.ranks[mode]
+        rank = index.getRank(userid)
+        if rank is None:
+            defer.returnValue(None)
+        defer.returnValue(dict(rank=rank, users=len(index),
+                points=self._rankedPoints(mode, index.getScore(userid))))
+
+    @defer.inlineCallbacks
+    def getNeighbours(self, userid, k, mode=const.LONGTERM_MODE):
+        yield self._waitForRanks()
+        neighbours = self.ranks[mode].getNeighbours(userid, k)
+        names = yield self.highscore.users.getDisplayNames(
+                uid for _, uid, _ in neighbours)
+        defer.returnValue([
+            dict(rank=rank, userid=uid, display_name=names[uid],
+                 points=self._rankedPoints(mode, score))
+            for rank, uid, score in neighbours ])
+
+    # leaderboards
+
+    def getHighscores(self, mode, limit=None, offset=0, window=None,
+                      start=None, end=None, source=None, repo=None,
+                      event_type=None):
+        # if a window specification (see highscore.util.windows) or start or
+        # end is given, mode is ignored and the scores are the points earned
+        # in [start, end); either may be None for an open end.  The scores
+        # can be limited to one of source, repo or event_type, except in
+        # DECAYED_MODE.
+        key = (mode, limit, offset, window, start, end,
+               source, repo, event_type)
+        now = reactor.seconds()
+        if key in self._scoresCache:
+            expires, scores = self._scoresCache[key]
+            if now < expires:
+                return defer.succeed(list(scores))
+            del self._scoresCache[key]
+
+        if key in self._scoresInFlight:
+            d = defer.Deferred()
+            self._scoresInFlight[key].append(d)
+            return d
+
+        waiters = self._scoresInFlight[key] = []
+        generation = self._scoresGeneration
+        def done(scores):
+            if self._scoresInFlight.get(key) is waiters:
+                del self._scoresInFlight[key]
+            # don't cache scores that may have changed during the query
+            if generation == self._scoresGeneration:
+                self._pruneHighscores()
+                self._scoresCache[key] = (reactor.seconds() + self.cacheTTL,
+                                          scores)
+            for d in waiters:
+                d.callback(list(scores))
+            return list(scores)
+        def failed(f):
+            if self._scoresInFlight.get(key) is waiters:
+                del self._scoresInFlight[key]
+            for d in waiters:
+                d.errback(f)
+            return f
+        d = self._queryHighscores(mode, limit, offset, window, start, end,
+                                  source, repo, event_type)
+        d.addCallbacks(done, failed)
+        return d
+
+    def invalidateHighscores(self):
+        # forget all cached scores, and let queries started from now on run
+        # separately from those already in flight
+        self._scoresCache = {}
+        self._scoresInFlight = {}
+        self._scoresGeneration += 1
+
+    def _pruneHighscores(self):
+        now = reactor.seconds()
+        for key, (expires, _) in self._scoresCache.items():
+            if expires <= now:
+                del self._scoresCache[key]
+
+    @defer.inlineCallbacks
+    def _queryHighscores(self, mode, limit, offset, window, start, end,
+                         source, repo, event_type):
+        filters = [ (prefix, value) for prefix, value in
+                    [ ('source', source), ('repo', repo),
+                      ('event', event_type) ]
+                    if value is not None ]
+        if len(filters) > 1:
+            raise ValueError("only one of source, repo and event_type "
+                             "may be given")
+        scope = ':'.join(filters[0]) if filters else ''
+
+        if window is not None:
+            start, end, _ = windows.parseWindow(window)
+        if start is not None or end is not None:
+            scores = yield self._getWindowHighscores(start, end, limit, offset,
+                                                     scope)
+            defer.returnValue(scores)
+
+        if mode == const.DECAYED_MODE and scope:
+            raise ValueError("decayed scores are only kept globally")
+
+        if mode == const.MONTHLY_MODE:
+            yield self.expireMonthly()
+
+        def thd(conn):
+            totalsTbl = self.highscore.db.model.user_totals
+            usersTbl = self.highscore.db.model.users
+
+            r = conn.execute(sa.select([ usersTbl.c.display_name,
+                  totalsTbl.c.userid, totalsTbl.c.points ],
+                  (usersTbl.c.id == totalsTbl.c.userid) &
+                  (totalsTbl.c.scope == scope) &
+                  (totalsTbl.c.mode == mode),
+                  order_by=[ sa.desc(totalsTbl.c.points),
+                             sa.desc(totalsTbl.c.userid) ],
+                  limit=limit, offset=offset))
+
+            return [ dict(points=row.points, userid=row.userid,
+                          display_name=row.display_name)
+                     for row in r ]
+
+        def thdDecayed(conn):
+            decayedTbl = self.highscore.db.model.decayed_totals
             usersTbl = self.highscore.db.model.users
 
             now = time.time()
+            mult = self.aggregates.decay(
+                    self.aggregates.thd_getDecayEpoch(conn, now), now)
+            r = conn.execute(sa.select([ usersTbl.c.display_name,
+                  decayedTbl.c.userid, decayedTbl.c.score ],
+                  (usersTbl.c.id == decayedTbl.c.userid),
+                  order_by=[ sa.desc(decayedTbl.c.score),
+                             sa.desc(decayedTbl.c.userid) ],
+                  limit=limit, offset=offset))
+
+            return [ dict(points=round(row.score * mult, 2),
+                          userid=row.userid,
+                          display_name=row.display_name)
+                     for row in r ]
 
-            if mode == const.MONTHLY_MODE:
-                r = conn.execute(sa.select([ usersTbl.c.display_name,
-                      pointsTbl.c.userid, pointsTbl.c.when,
-                      pointsTbl.c.points ],
-                      (usersTbl.c.id == pointsTbl.c.userid) &
-                      (now - pointsTbl.c.when <= self.HALFLIFE)))
-            else:
-                r = conn.execute(sa.select([ usersTbl.c.display_name,
-                      pointsTbl.c.userid, pointsTbl.c.when,
-                      pointsTbl.c.points ],
-                      (usersTbl.c.id == pointsTbl.c.userid) &
-                      (pointsTbl.c.when > 0)))
-
-            user_points = {}
-            user_names = {}
-            for row in r:
-                if row.userid not in user_names:
-                    user_names[row.userid] = row.display_name
-                    user_points[row.userid] = 0
-                user_points[row.userid] += row.points
-
-            # sort highest scores
-            by_score = sorted(
-                    [ (p, u) for (u, p) in user_points.iteritems() ],
-                    reverse=True)
-            by_score = [ dict(points=p, userid=u, display_name=user_names[u])
-                         for (p, u) in by_score ]
-
-            return by_score
-        return self.highscore.db.pool.do(thd)
+        if mode == const.DECAYED_MODE:
+            # this may rebase the decayed totals, so it is a write
+            by_score = yield self.highscore.db.pool.do(thdDecayed)
+        else:
+            by_score = yield self.highscore.db.pool.do_read(thd)
+        defer.returnValue(by_score)
+
+    def _getWindowHighscores(self, start, end, limit, offset, scope):
+        def thd(conn):
+            usersTbl = self.highscore.db.model.users
+
+            window = self.aggregates.thd_windowQuery(conn, start, end, scope)
+            total = sa.func.sum(window.c.points).label('total')
+            r = conn.execute(sa.select([ usersTbl.c.display_name,
+                  window.c.userid, total ],
+                  (usersTbl.c.id == window.c.userid),
+                  group_by=[ window.c.userid, usersTbl.c.display_name ],
+                  having=(total != 0),
+                  order_by=[ sa.desc(total), sa.desc(window.c.userid) ],
+                  limit=limit, offset=offset))
 
+            return [ dict(points=row.total, userid=row.userid,
+                          display_name=row.display_name)
+                     for row in r ]
+        return self.highscore.db.pool.do_read(thd)
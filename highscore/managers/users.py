@@ -14,7 +14,10 @@
 # Copyright Buildbot Team Members
 
 import sqlalchemy as sa
+from twisted.internet import defer
+from twisted.python import log, failure
 from twisted.application import service
+from highscore.util import lru
 
 class UsersManager(service.MultiService):
 
@@ -23,19 +26,58 @@ class UsersManager(service.MultiService):
         self.setName('highscore.users')
         self.highscore = highscore
         self.config = config
+
+        # user_attr_types, loaded when the service starts.  Types that were
+        # looked up but do not exist are remembered in _missingTypes, as no
+        # user can match them until they are created.
         self._typeCache = {}
+        self._missingTypes = set()
 
-    def _thd_getUserAttrTypeId(self, conn, type):
-        # if it's cached, this is easy
-        if type in self._typeCache:
-            return self._typeCache[type]
+        # (attr type, value) -> (userid, display_name) for recently resolved
+        # identities, and userid -> display_name.  Anything that changes users
+        # or users_info must call one of the invalidate methods;
+        # cacheGeneration keeps results from queries that overlapped an
+        # invalidation out of the caches.
+        self.identityCache = lru.LRUCache(
+                config.users.get('identity_cache_size', 1000))
+        self.nameCache = lru.LRUCache(
+                config.users.get('name_cache_size', 10000))
+        self.cacheGeneration = 0
+
+        # first matchInfo entry -> Deferreds waiting for the getUserIdsAndNames
+        # call that is already resolving it
+        self._identitiesInFlight = {}
 
-        # otherwise, try to reload the cache
+    def startService(self):
+        service.MultiService.startService(self)
+        d = self.highscore.db.pool.do(self._thd_loadUserAttrTypes)
+        d.addErrback(log.err, 'while loading user attribute types')
+
+    def _thd_loadUserAttrTypes(self, conn):
         tbl = self.highscore.db.model.user_attr_types
         for row in conn.execute(tbl.select()):
             self._typeCache[row.type] = row.id
+            self._missingTypes.discard(row.type)
+
+    def _thd_getUserAttrTypeId(self, conn, type, create=True):
+        # return the id of an attribute type, adding it if create is true and
+        # returning None otherwise.  If it's cached, this is easy
         if type in self._typeCache:
             return self._typeCache[type]
+        if not create and type in self._missingTypes:
+            return None
+
+        # otherwise, look for just this type
+        tbl = self.highscore.db.model.user_attr_types
+        row = conn.execute(sa.select([ tbl.c.id ],
+                                     tbl.c.type == type)).fetchone()
+        if row:
+            self._typeCache[type] = row.id
+            self._missingTypes.discard(type)
+            return row.id
+        if not create:
+            self._missingTypes.add(type)
+            return None
 
         # otherwise, try to add it, handling collisions
         transaction = conn.begin()
@@ -44,6 +86,7 @@ class UsersManager(service.MultiService):
             id = r.inserted_primary_key[0]
             transaction.commit()
             self._typeCache[type] = id
+            self._missingTypes.discard(type)
             return id
         except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
             transaction.rollback()
@@ -53,60 +96,390 @@ class UsersManager(service.MultiService):
     def getUserIdAndName(self, matchInfo=[], suggestedInfo=[],
                          suggestedDisplayName=None):
         # info is represented as lists of tuples (type, value)
+        d = self.getUserIdsAndNames([
+                (matchInfo, suggestedInfo, suggestedDisplayName) ])
+        d.addCallback(lambda results : results[0])
+        return d
+
+    @defer.inlineCallbacks
+    def getUserIdsAndNames(self, identities):
+        # resolve a list of (matchInfo, suggestedInfo, suggestedDisplayName)
+        # to a list of (userid, display_name), as for getUserIdAndName, with
+        # one query for all of the matchInfo and one transaction to create
+        # any missing users, with a multi-row insert of their users_info
+        results = [ None ] * len(identities)
+
+        # matchInfo is tried in order, so the cache can only answer for the
+        # first entry.  Identities that are already being resolved, by this
+        # call or another, wait for that rather than racing to create the
+        # same user.
+        pending = []
+        leaders = {}
+        followers = []
+        waiting = []
+        for i, (matchInfo, _, _) in enumerate(identities):
+            if not matchInfo:
+                pending.append(i)
+                continue
+            key = tuple(matchInfo[0])
+            cached = self.identityCache.get(key)
+            if cached is not None:
+                results[i] = cached
+            elif key in leaders:
+                followers.append((i, leaders[key]))
+            elif key in self._identitiesInFlight:
+                d = defer.Deferred()
+                self._identitiesInFlight[key].append(d)
+                waiting.append((i, d))
+            else:
+                leaders[key] = i
+                self._identitiesInFlight[key] = []
+                pending.append(i)
 
         def thd(conn, no_recurse=False):
             usersTbl = self.highscore.db.model.users
             infoTbl = self.highscore.db.model.users_info
 
-            # try to find the user
-            for type, value in matchInfo:
-                matchTypeId = self._thd_getUserAttrTypeId(conn, type)
-                res = conn.execute(sa.select(
-                    [ usersTbl.c.display_name, usersTbl.c.id ],
+            # types that do not exist yet can't match anyone; thdTypes has
+            # looked up or created every type needed here
+            typeIds = {}
+            for i in pending:
+                for type, _ in identities[i][0]:
+                    typeIds[type] = self._typeCache.get(type)
+
+            # try to find all of the users at once
+            found = self._thd_findUsers(conn, typeIds,
+                    [ tuple(info) for i in pending
+                                  for info in identities[i][0]
+                                  if typeIds[info[0]] is not None ])
+
+            resolved = {}
+            toCreate = []
+            for i in pending:
+                matchInfo, suggestedInfo, suggestedDisplayName = identities[i]
+                for info in matchInfo:
+                    info = tuple(info)
+                    if info in found:
+                        resolved[i] = found[info] + ([ info ],)
+                        break
+                else:
+                    toCreate.append(i)
+
+            # the rest were not found, so we need to insert new users entries
+            # as well as their suggestedInfo.  The same identity may appear
+            # more than once, so only create one user for each.
+            creating = {}
+            newUsers = []
+            for i in toCreate:
+                matchInfo, suggestedInfo, suggestedDisplayName = identities[i]
+                for info in matchInfo:
+                    if tuple(info) in creating:
+                        break
+                else:
+                    newUsers.append(i)
+                    for info in suggestedInfo:
+                        creating[tuple(info)] = i
+
+            if newUsers:
+                for i in newUsers:
+                    for type, _ in identities[i][1]:
+                        typeIds[type] = self._typeCache[type]
+
+                transaction = conn.begin()
+                try:
+                    # each user's id comes from its own insert; with more
+                    # than one writer, neither max(id) nor the ids of a
+                    # multi-row insert can be relied on
+                    ids = []
+                    for i in newUsers:
+                        name = identities[i][2]
+                        r = conn.execute(usersTbl.insert(), dict(
+                            display_name=name, name_key=self.nameKey(name)))
+                        ids.append(r.inserted_primary_key[0])
+
+                    infoRows = []
+                    for i, userid in zip(newUsers, ids):
+                        matchInfo, suggestedInfo, suggestedDisplayName = \
+                                identities[i]
+                        resolved[i] = (userid, suggestedDisplayName,
+                                       suggestedInfo)
+                        infoRows.extend(
+                            dict(userid=userid, attrtypeid=typeIds[info[0]],
+                                 value=info[1])
+                            for info in suggestedInfo)
+                    if infoRows:
+                        conn.execute(infoTbl.insert(), infoRows)
+                    transaction.commit()
+                except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
+                    transaction.rollback()
+
+                    # try it all over again, in case there was an overlapping,
+                    # identical call to findUserByAttr, but only retry once.
+                    if no_recurse:
+                        raise
+                    return thd(conn, no_recurse=True)
+
+            # identities that duplicated a new user get the same answer
+            for i in toCreate:
+                if i not in resolved:
+                    for info in identities[i][0]:
+                        if tuple(info) in creating:
+                            userid, name, _ = resolved[creating[tuple(info)]]
+                            resolved[i] = (userid, name, [])
+                            break
+            return resolved
+
+        # thd runs in a shared transaction that may yet be rolled back or
+        # retried, so it must not update _typeCache.  Look up or create the
+        # types it needs first, in their own transaction.
+        matchTypes = set(type for i in pending
+                              for type, _ in identities[i][0]
+                              if type not in self._typeCache and
+                                 type not in self._missingTypes)
+        newTypes = set(type for i in pending
+                            for type, _ in identities[i][1]
+                            if type not in self._typeCache)
+        def thdTypes(conn):
+            for type in matchTypes - newTypes:
+                self._thd_getUserAttrTypeId(conn, type, create=False)
+            for type in newTypes:
+                self._thd_getUserAttrTypeId(conn, type)
+
+        if pending:
+            generation = self.cacheGeneration
+            try:
+                if matchTypes or newTypes:
+                    yield self.highscore.db.pool.do(thdTypes)
+                resolved = yield self.highscore.db.pool.do_grouped(thd)
+            except:
+                f = failure.Failure()
+                for key in leaders:
+                    for d in self._identitiesInFlight.pop(key):
+                        d.errback(f)
+                # nothing will wait for the other calls' results now, but
+                # their Deferreds must not be left with unhandled errors
+                for i, d in waiting:
+                    d.addErrback(lambda _ : None)
+                f.raiseException()
+
+            for i, (userid, display_name, infos) in resolved.iteritems():
+                results[i] = (userid, display_name)
+                if generation == self.cacheGeneration:
+                    for info in infos:
+                        self.identityCache.put(tuple(info),
+                                               (userid, display_name))
+                    self.nameCache.put(userid, display_name)
+            for key, i in leaders.iteritems():
+                for d in self._identitiesInFlight.pop(key):
+                    d.callback(results[i])
+
+        for i, leader in followers:
+            results[i] = results[leader]
+        if waiting:
+            waited = yield defer.DeferredList([ d for _, d in waiting ],
+                                              consumeErrors=True)
+            for (i, _), (ok, result) in zip(waiting, waited):
+                if not ok:
+                    result.raiseException()
+                results[i] = result
+        defer.returnValue(results)
+
+    def _thd_findUsers(self, conn, typeIds, infos):
+        # return {(type, value): (userid, display_name)} for those of infos
+        # that belong to a user
+        usersTbl = self.highscore.db.model.users
+        infoTbl = self.highscore.db.model.users_info
+
+        byType = {}
+        for type, value in set(infos):
+            byType.setdefault(typeIds[type], []).append(value)
+        types = dict((id, type) for type, id in typeIds.iteritems())
+
+        found = {}
+        for typeId, values in byType.iteritems():
+            # stay well below the limit on bound parameters per query
+            for j in xrange(0, len(values), 500):
+                r = conn.execute(sa.select(
+                    [ usersTbl.c.id, usersTbl.c.display_name,
+                      infoTbl.c.value ],
                     (infoTbl.c.userid == usersTbl.c.id) &
-                    (infoTbl.c.attrtypeid == matchTypeId) &
-                    (infoTbl.c.value == value)))
-                row = res.fetchone()
-                res.close()
-                if row:
-                    return row.id, row.display_name
-
-            # the user was not found, so we need to insert a new users entry
-            # as well as the suggestedInfo.
+                    (infoTbl.c.attrtypeid == typeId) &
+                    infoTbl.c.value.in_(values[j:j+500])))
+                for row in r:
+                    found[(types[typeId], row.value)] = \
+                            (row.id, row.display_name)
+        return found
+
+    def findUser(self, type, value):
+        # return (userid, display_name) for the user with this attribute, or
+        # None; unlike getUserIdAndName, this never creates a user
+        cached = self.identityCache.get((type, value))
+        if cached is not None:
+            return defer.succeed(cached)
+        def thd(conn):
+            typeId = self._thd_getUserAttrTypeId(conn, type, create=False)
+            if typeId is None:
+                return None
+            found = self._thd_findUsers(conn, { type : typeId },
+                                        [ (type, value) ])
+            return found.get((type, value))
+        return self.highscore.db.pool.do_read(thd)
+
+    @defer.inlineCallbacks
+    def mergeUsers(self, src, dst):
+        # merge user src into user dst: src's attributes and points become
+        # dst's, and src is deleted.  This runs in batches, while points
+        # continue to be added.  Returns the number of points moved.
+        if src == dst:
+            raise ValueError("cannot merge a user into itself")
+
+        def thdInfo(conn):
+            usersTbl = self.highscore.db.model.users
+            infoTbl = self.highscore.db.model.users_info
             transaction = conn.begin()
             try:
-                r = conn.execute(usersTbl.insert(),
-                        dict(display_name=suggestedDisplayName))
-                userid = r.inserted_primary_key[0]
-
-                conn.execute(infoTbl.insert(), [
-                    dict(userid=userid,
-                         attrtypeid=self._thd_getUserAttrTypeId(conn, info[0]),
-                         value=info[1])
-                    for info in suggestedInfo ])
+                found = conn.execute(sa.select([ sa.func.count() ],
+                        usersTbl.c.id.in_([ src, dst ]))).scalar()
+                if found != 2:
+                    raise KeyError("no such user")
+                conn.execute(infoTbl.update(infoTbl.c.userid == src)
+                             .values(userid=dst))
                 transaction.commit()
-            except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
+            except:
                 transaction.rollback()
+                raise
+        yield self.highscore.db.pool.do(thdInfo)
 
-                # try it all over again, in case there was an overlapping,
-                # identical call to findUserByAttr, but only retry once.
-                if no_recurse:
-                    raise
-                return thd(conn, no_recurse=True)
+        # from here on, src's identities resolve to dst
+        self.invalidateUser(src)
+        self.invalidateUser(dst)
 
-            return userid, suggestedDisplayName
-        return self.highscore.db.pool.do(thd)
+        moved = yield self.highscore.points.mergePoints(src, dst)
 
-    def getDisplayName(self, userid):
+        def thdDelete(conn):
+            usersTbl = self.highscore.db.model.users
+            pointsTbl = self.highscore.db.model.points
+            transaction = conn.begin()
+            try:
+                # points that were in flight for src when it was merged
+                # would be stranded, so leave it if there are any
+                if conn.execute(sa.select([ pointsTbl.c.id ],
+                        pointsTbl.c.userid == src, limit=1)).fetchone():
+                    transaction.rollback()
+                    return False
+                conn.execute(usersTbl.delete(usersTbl.c.id == src))
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            return True
+        deleted = yield self.highscore.db.pool.do(thdDelete)
+        self.invalidateUser(src)
+        if not deleted:
+            log.msg("user %d received points while being merged into user "
+                    "%d; merge again to finish" % (src, dst))
+        defer.returnValue(moved)
+
+    @staticmethod
+    def nameKey(display_name):
+        # the form of a display name that is indexed for searching: lower
+        # case, with runs of whitespace collapsed
+        if display_name is None:
+            return u''
+        if isinstance(display_name, str):
+            display_name = display_name.decode('utf-8', 'replace')
+        return u' '.join(display_name.lower().split())[:256]
+
+    def searchUsers(self, prefix, limit=10):
+        # return up to 'limit' users, as dictionaries with keys userid and
+        # display_name, whose display names begin with 'prefix', ignoring
+        # case.  This is a range scan of the users_name_key index.
+        key = self.nameKey(prefix)
+        if not key:
+            return defer.succeed([])
         def thd(conn):
             usersTbl = self.highscore.db.model.users
-            r = conn.execute(sa.select([ usersTbl.c.display_name ],
-                usersTbl.c.id == userid))
-            row = r.fetchone()
-            r.close()
-            if row:
-                return row.display_name
+            r = conn.execute(sa.select(
+                [ usersTbl.c.id, usersTbl.c.display_name ],
+                (usersTbl.c.name_key >= key) &
+                (usersTbl.c.name_key < key + u'\uffff'),
+                order_by=[ usersTbl.c.name_key, usersTbl.c.id ],
+                limit=limit))
+            return [ dict(userid=row.id, display_name=row.display_name)
+                     for row in r ]
+        return self.highscore.db.pool.do_read(thd)
+
+    def invalidateIdentity(self, type, value):
+        self.cacheGeneration += 1
+        self.identityCache.pop((type, value))
+
+    def invalidateUser(self, userid):
+        # forget every identity of userid, e.g., after changing its name
+        self.cacheGeneration += 1
+        self.identityCache.discardWhere(lambda key, value : value[0] == userid)
+        self.nameCache.pop(userid)
+
+    def invalidateIdentities(self):
+        self.cacheGeneration += 1
+        self.identityCache.clear()
+        self.nameCache.clear()
+
+    def getIdentityCacheStats(self):
+        return dict(identities=self.identityCache.getStats(),
+                    names=self.nameCache.getStats())
+
+    def getDisplayName(self, userid):
+        d = self.getDisplayNames([ userid ])
+        d.addCallback(lambda names : names[userid])
+        return d
+
+    def getDisplayNames(self, userids):
+        # return a dictionary mapping each of userids to its display name,
+        # querying only for those that are not cached
+        names, missing = self.getCachedDisplayNames(userids)
+        if not missing:
+            return defer.succeed(names)
+
+        generation = self.cacheGeneration
+        d = self.highscore.db.pool.do_read(self.thd_getDisplayNames, missing)
+        @d.addCallback
+        def cache(found):
+            self.cacheDisplayNames(found, generation)
+            for userid in missing:
+                names[userid] = found.get(userid, '(unknown)')
+            return names
+        return d
+
+    # getDisplayNames in pieces, for callers that want to look up names as
+    # part of a larger transaction: get what is cached, query the rest in the
+    # DB thread, then cache the results, giving the generation from before
+    # the query
+
+    def getCachedDisplayNames(self, userids):
+        names = {}
+        missing = []
+        for userid in set(userids):
+            name = self.nameCache.get(userid)
+            if name is None:
+                missing.append(userid)
             else:
-                return '(unknown)'
-        return self.highscore.db.pool.do(thd)
+                names[userid] = name
+        return names, missing
+
+    def thd_getDisplayNames(self, conn, userids):
+        usersTbl = self.highscore.db.model.users
+        names = {}
+        userids = list(userids)
+        # stay well below the limit on bound parameters per query
+        for i in xrange(0, len(userids), 500):
+            r = conn.execute(sa.select(
+                [ usersTbl.c.id, usersTbl.c.display_name ],
+                usersTbl.c.id.in_(userids[i:i+500])))
+            names.update((row.id, row.display_name) for row in r)
+        return names
 
+    def cacheDisplayNames(self, names, generation):
+        if generation != self.cacheGeneration:
+            return
+        for userid, name in names.iteritems():
+            self.nameCache.put(userid, name)
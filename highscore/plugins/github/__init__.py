@@ -71,6 +71,16 @@ class Plugin(base.Plugin):
     def _truncateSha1(self, text):
         return text[:8]
 
+    def _repoName(self, message):
+        # the "owner/name" of the repository an event is about, if any
+        repo = message['payload'].get('repository')
+        if not repo:
+            return None
+        if 'full_name' in repo:
+            return repo['full_name']
+        owner = repo['owner']
+        return '%s/%s' % (owner.get('login') or owner['name'], repo['name'])
+
     def mqHandle_push(self, key, message):
         truncText = self._truncateText
         truncSha1 = self._truncateSha1
@@ -94,7 +104,10 @@ class Plugin(base.Plugin):
                 userid=message['userid'],
                 points=1,
                 comments='for pushing %(commitSha1)s to '
-                         '%(repoOwner)s/%(repoName)s' % subs)
+                         '%(repoOwner)s/%(repoName)s' % subs,
+                source='github',
+                repo=self._repoName(message),
+                event_type='push')
 
     def mqHandle_issue_comment(self, key, message):
         truncText = self._truncateText
@@ -120,7 +133,10 @@ class Plugin(base.Plugin):
                 userid=message['userid'],
                 points=1,
                 comments='for %(issueOrPull)s #%(number)s comment: '
-                         '%(comment)s' % subs)
+                         '%(comment)s' % subs,
+                source='github',
+                repo=self._repoName(message),
+                event_type='issue_comment')
 
     actionGerunds = dict(
             opened='opening', closed='closing', reopened='reopening')
@@ -150,7 +166,10 @@ class Plugin(base.Plugin):
                 userid=message['userid'],
                 points=1,
                 comments='for %(actioning)s %(issueOrPull)s #%(number)s: '
-                         '%(title)s' % subs)
+                         '%(title)s' % subs,
+                source='github',
+                repo=self._repoName(message),
+                event_type='issues')
 
     def mqHandle_commit_comment(self, key, message):
         truncText = self._truncateText
@@ -170,7 +189,10 @@ class Plugin(base.Plugin):
         self.highscore.points.addPoints(
                 userid=message['userid'],
                 points=1,
-                comments='for commit comment %(commentUrl)s' % subs)
+                comments='for commit comment %(commentUrl)s' % subs,
+                source='github',
+                repo=self._repoName(message),
+                event_type='commit_comment')
 
     def mqHandle_pull_request(self, key, message):
         truncText = self._truncateText
@@ -193,5 +215,8 @@ class Plugin(base.Plugin):
                 userid=message['userid'],
                 points=1,
                 comments='for %(actioning)s %(issueOrPull)s #%(number)s: '
-                         '%(title)s' % subs)
+                         '%(title)s' % subs,
+                source='github',
+                repo=self._repoName(message),
+                event_type='pull_request')
 
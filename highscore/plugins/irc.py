@@ -15,7 +15,10 @@
 
 import re
 import random
+import fnmatch
 from highscore.plugins import base
+from highscore.const import ConstMaster as const
+from highscore.util import windows
 from twisted.words.protocols import irc
 from twisted.internet import reactor, protocol, defer
 from twisted.python import log
@@ -128,6 +131,8 @@ class IrcProtocol(irc.IRCClient):
             self.begin()
 
     plusplus_re = re.compile(r'^([^ ]*)\+\+(.*)')
+    whois_re = re.compile(r'^whois(?:\s+(.*))?$')
+    merge_users_re = re.compile(r'^merge_users(?:\s+(.*))?$')
     def privmsg(self, user, channel, msg):
         nick = user.split('!', 1)[0]
         if channel == self.nickname:
@@ -136,7 +141,22 @@ class IrcProtocol(irc.IRCClient):
             return
 
         if msg.startswith('top_ten'):
-            self.sendTopTen(nick)
+            # e.g., "top_ten week"; see highscore.util.windows
+            self.sendTopTen(nick, msg[len('top_ten'):].strip())
+            return
+
+        mo = self.whois_re.match(msg)
+        if mo:
+            # e.g., "whois dus" lists the users whose names begin "dus"
+            d = self.sendWhois(nick, (mo.group(1) or '').strip())
+            d.addErrback(log.msg, "while searching for users")
+            return
+
+        mo = self.merge_users_re.match(msg)
+        if mo:
+            # e.g., "merge_users dustin github-username:djmitche"
+            d = self.mergeUsers(user, (mo.group(1) or '').split())
+            d.addErrback(log.msg, "while merging users")
             return
 
         if msg.startswith(self.nickname + ":"):
@@ -183,13 +203,82 @@ class IrcProtocol(irc.IRCClient):
         comments = comments.strip()
         if not comments:
             comments = "from %s in irc" % (source_nick,)
+        event_type = 'plusplus'
         if source_nick == dest_nick and points > 0:
             points = -5
             comments = "for being greedy"
+            event_type = 'greedy'
         userid, _ = \
                 yield self.getUserIdAndName(dest_nick)
         yield self.highscore.points.addPoints(userid=userid, points=points,
-                                              comments=comments)
+                                              comments=comments, source='irc',
+                                              event_type=event_type)
+
+    @defer.inlineCallbacks
+    def sendWhois(self, nick, prefix):
+        if not prefix:
+            self.publicMsg("%s: usage: whois NAME" % (nick,))
+            return
+        users = yield self.highscore.users.searchUsers(prefix, limit=6)
+        if not users:
+            self.publicMsg("%s: nobody matches %s" % (nick, prefix))
+            return
+        for user in users[:5]:
+            rank = yield self.highscore.points.getUserRank(user['userid'],
+                                                          const.LONGTERM_MODE)
+            if rank:
+                self.publicMsg("%s: %s (%d points, %s) %s" % (nick,
+                        user['display_name'], rank['points'],
+                        self.posSuffixStr(rank['rank']).strip(),
+                        self.highscore.www.makeUrl('user', user['userid'])))
+            else:
+                self.publicMsg("%s: %s (no points) %s" % (nick,
+                        user['display_name'],
+                        self.highscore.www.makeUrl('user', user['userid'])))
+        if len(users) > 5:
+            self.publicMsg("%s: ...and more" % (nick,))
+
+    @defer.inlineCallbacks
+    def mergeUsers(self, user, args):
+        nick = user.split('!', 1)[0]
+        if not self.isAdmin(user):
+            self.publicMsg("%s: only admins can merge users" % (nick,))
+            return
+        if len(args) != 2:
+            self.publicMsg("%s: usage: merge_users FROM INTO, where each is "
+                           "a nick or TYPE:VALUE" % (nick,))
+            return
+
+        users = []
+        for arg in args:
+            if ':' in arg:
+                type, value = arg.split(':', 1)
+            else:
+                type, value = 'irc_nick', arg
+            found = yield self.highscore.users.findUser(type, value)
+            if not found:
+                self.publicMsg("%s: no such user %s" % (nick, arg))
+                return
+            users.append(found)
+        (src, srcName), (dst, dstName) = users
+        if src == dst:
+            self.publicMsg("%s: those are the same user" % (nick,))
+            return
+
+        self.publicMsg("%s: merging %s into %s" % (nick, srcName, dstName))
+        moved = yield self.highscore.users.mergeUsers(src, dst)
+        self.publicMsg("%s: merged %s into %s, moving %d points"
+                       % (nick, srcName, dstName, moved))
+
+    def isAdmin(self, user):
+        # admins are configured as nick!user@host masks, which may contain
+        # wildcards; anyone can use an admin's nick, so the whole mask must
+        # match
+        user = user.lower()
+        for mask in self.config.plugins.irc.get('admins', []):
+            if fnmatch.fnmatchcase(user, mask.lower()):
+                return True
+        return False
 
     def posSuffixStr(self, pos):
         if pos == 1:
@@ -208,12 +297,24 @@ class IrcProtocol(irc.IRCClient):
  
         return pref + str(pos) + posstr
     
-    def sendTopTen(self, nick):
-        d = self.highscore.points.getHighscores()
+    def sendTopTen(self, nick, window=''):
+        title = "Top Ten Buildbot Contributors"
+        if window:
+            try:
+                _, _, description = windows.parseWindow(window)
+            except ValueError, e:
+                self.publicMsg("%s: %s" % (nick, e))
+                return
+            title += " (%s)" % (description,)
+            d = self.highscore.points.getHighscores(None, limit=10,
+                                                    window=window)
+        else:
+            d = self.highscore.points.getHighscores(const.LONGTERM_MODE,
+                                                    limit=10)
         @d.addCallback
         def printData(data):
             i = 1 
-            self.publicMsg("Top Ten Buildbot Contributors")
+            self.publicMsg(title)
             for item in data:
                 self.publicMsg(self.posSuffixStr(i) + " " +
                                item['display_name'] + " " +
@@ -0,0 +1,111 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import time
+import signal
+import multiprocessing
+from highscore.db import enginestrategy, model, aggregates
+from highscore.managers.points import PointsManager
+
+# The rebuild is split into userid ranges that are computed into staging tables
+# by a pool of worker processes, then swapped in at once; see the comments in
+# highscore.db.aggregates.  The plan and the completed ranges are recorded in
+# the database, so an interrupted rebuild picks up where it left off.
+
+def makeEngine(db, basedir):
+    return enginestrategy.create_engine(db, basedir=os.path.abspath(basedir))
+
+def makeAggregates():
+    return aggregates.Aggregates(model.Model, PointsManager.HALFLIFE)
+
+# the engine for a worker process
+_engine = None
+
+def _initWorker(db, basedir):
+    global _engine
+    # leave ^C to the parent, which will terminate the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _engine = makeEngine(db, basedir)
+
+def _rebuildRange((plan, i)):
+    start = time.time()
+    conn = _engine.contextual_connect()
+    try:
+        count = makeAggregates().thd_rebuildRange(conn, plan, i)
+    finally:
+        conn.close()
+    return i, count, time.time() - start
+
+def rebuildAggregates(config):
+    db, basedir = config['db'], config['basedir']
+    aggs = makeAggregates()
+    start = time.time()
+
+    engine = makeEngine(db, basedir)
+    conn = engine.contextual_connect()
+    try:
+        if config['restart']:
+            aggs.thd_discardRebuild(conn)
+        plan = aggs.thd_planRebuild(conn, start, config['range-size'])
+    finally:
+        conn.close()
+        # don't let the workers inherit open connections
+        engine.dispose()
+
+    ranges = plan['ranges']
+    todo = [ i for i in xrange(len(ranges)) if i not in plan['done'] ]
+    if plan['done']:
+        print "resuming rebuild from %s: %d of %d ranges remain" % (
+                time.ctime(plan['now']), len(todo), len(ranges))
+
+    points = 0
+    pool = multiprocessing.Pool(config['workers'], _initWorker, (db, basedir))
+    try:
+        results = pool.imap_unordered(_rebuildRange,
+                                      [ (plan, i) for i in todo ])
+        for n in xrange(1, len(todo) + 1):
+            # waiting with a timeout keeps ^C working
+            i, count, elapsed = results.next(timeout=3600*24*365)
+            points += count
+            lo, hi = ranges[i]
+            print "users %d-%d: %d points in %.2fs (%d/%d, %.0f points/s)" % (
+                    lo, hi - 1, count, elapsed, n, len(todo),
+                    points / (time.time() - start))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print "interrupted; run the command again to resume"
+        return 1
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    engine = makeEngine(db, basedir)
+    conn = engine.contextual_connect()
+    try:
+        added = aggs.thd_finishRebuild(conn, plan)
+    finally:
+        conn.close()
+        engine.dispose()
+
+    elapsed = time.time() - start
+    print "rebuilt aggregates from %d points in %.2fs (%.0f points/s)" % (
+            points, elapsed, points / elapsed)
+    if added:
+        print "included %d points added during the rebuild" % (added,)
+    return 0
@@ -0,0 +1,87 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+# N.B.: don't import anything that might pull in the reactor yet. Some of our
+# subcommands run without it.
+
+import sys
+from twisted.python import usage
+
+class DBOptions(usage.Options):
+    # options common to subcommands that talk directly to the database
+
+    optParameters = [
+        ['db', None, 'sqlite:///highscore.sqlite',
+         "database URL, as given in the 'db' section of the configuration"],
+        ['basedir', 'd', '.', 'highscore base directory'],
+    ]
+
+class RebuildAggregatesOptions(DBOptions):
+    subcommandFunction = \
+            "highscore.scripts.rebuild_aggregates.rebuildAggregates"
+
+    optFlags = [
+        ['restart', None,
+         "discard an interrupted rebuild instead of resuming it"],
+    ]
+
+    optParameters = [
+        ['workers', 'j', None, "number of worker processes (default: one "
+                               "per CPU)", int],
+        ['range-size', None, 1000, "number of userids in each unit of work",
+         int],
+    ]
+
+    def getSynopsis(self):
+        return "Usage:    highscore rebuild-aggregates [options]"
+
+    longdesc = """
+    Recompute the leaderboard totals from the points table.  Use this after
+    fixing a bug in the aggregates, or after editing the points table by hand.
+    The work is split by userid range across several processes, and the new
+    totals replace the old ones all at once, so the bot can keep running; it
+    notices the new totals within a minute and reloads its user ranks.  An
+    interrupted rebuild resumes where it left off when run again.  Merging
+    users while a rebuild runs makes it fail; run it again with --restart.
+    """
+
+class Options(usage.Options):
+    synopsis = "Usage:    highscore <command> [command options]"
+
+    subCommands = [
+        ['rebuild-aggregates', None, RebuildAggregatesOptions,
+         "Recompute the leaderboard totals from the points table"],
+    ]
+
+    def postOptions(self):
+        if not hasattr(self, 'subOptions'):
+            raise usage.UsageError("must specify a command")
+
+
+def run():
+    config = Options()
+    try:
+        config.parseOptions(sys.argv[1:])
+    except usage.error, e:
+        print "%s:  %s" % (sys.argv[0], e)
+        print
+        c = getattr(config, 'subOptions', config)
+        print str(c)
+        sys.exit(1)
+
+    subconfig = config.subOptions
+    from twisted.python.reflect import namedObject
+    subcommandFunction = namedObject(subconfig.subcommandFunction)
+    sys.exit(subcommandFunction(subconfig))
@@ -0,0 +1,61 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from highscore.test import util
+
+class IncrementalVacuum(util.HighscoreMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore(db=dict(vacuum_pages=5, full_vacuum=True))
+        self.maintenance = self.highscore.db.maintenance
+        self.pool = self.highscore.db.pool
+
+        # the first pass switches the database to incremental vacuuming
+        yield self.maintenance.maintain()
+
+        # then fill some pages and free them again
+        def thd(conn):
+            stateTbl = self.highscore.db.model.state
+            conn.execute(stateTbl.insert(), [
+                dict(name='test-%d' % i, value='x' * 2000)
+                for i in range(100) ])
+            conn.execute(stateTbl.delete(stateTbl.c.name.startswith('test-')))
+            return conn.execute("pragma freelist_count").scalar()
+        self.free = yield self.pool.do(thd)
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    @defer.inlineCallbacks
+    def test_vacuum_in_chunks(self):
+        self.assertTrue(self.free > 10)
+        calls = []
+        do = self.pool.do
+        def countingDo(callable, *args, **kwargs):
+            calls.append(callable)
+            return do(callable, *args, **kwargs)
+        self.patch(self.pool, 'do', countingDo)
+
+        stats = yield self.maintenance.maintain()
+        self.assertEqual(stats['vacuumed_pages'], self.free)
+        self.assertEqual(len(calls), self.free // 5 + 1)
+
+        def thd(conn):
+            return conn.execute("pragma freelist_count").scalar()
+        free = yield do(thd)
+        self.assertEqual(free, 0)
@@ -0,0 +1,172 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from highscore.test import util
+
+class PersistentConnections(util.HighscoreMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        # a single reader thread, so that every read uses one connection
+        yield self.setUpHighscore(db=dict(read_pool_size=1))
+        self.pool = self.highscore.db.pool
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    def countState(self, conn):
+        stateTbl = self.highscore.db.model.state
+        return conn.execute(sa.select([ sa.func.count() ],
+                            from_obj=[ stateTbl ])).scalar()
+
+    @defer.inlineCallbacks
+    def test_reader_sees_later_commits(self):
+        self.assertTrue(self.pool.engine.wal_mode)
+        self.assertNotIdentical(self.pool.readers, self.pool)
+
+        # a read in a transaction that the DBAPI began behind SQLAlchemy's
+        # back, as MySQLdb does for any statement
+        def thdRead(conn):
+            conn.connection.cursor().execute("begin")
+            return self.countState(conn)
+        before = yield self.pool.do_read(thdRead)
+
+        def thdWrite(conn):
+            conn.execute(self.highscore.db.model.state.insert(),
+                         name='test', value='1')
+        yield self.pool.do(thdWrite)
+
+        after = yield self.pool.do_read(self.countState)
+        self.assertEqual(after, before + 1)
+
+
+class GroupCommit(util.HighscoreMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore(db=dict(group_commit_window=0.01))
+        self.pool = self.highscore.db.pool
+        self.patch(self.pool, 'BACKOFF_START', 0.01)
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    def insert(self, conn, name):
+        conn.execute(self.highscore.db.model.state.insert(),
+                     name='test-' + name, value='1')
+
+    def inserter(self, name, rv=None):
+        def thd(conn):
+            self.insert(conn, name)
+            return rv
+        return thd
+
+    @defer.inlineCallbacks
+    def getNames(self):
+        def thd(conn):
+            stateTbl = self.highscore.db.model.state
+            return sorted(row.name[5:] for row in conn.execute(
+                sa.select([ stateTbl.c.name ],
+                          stateTbl.c.name.startswith('test-'))))
+        names = yield self.pool.do(thd)
+        defer.returnValue(names)
+
+    @defer.inlineCallbacks
+    def runGroup(self, *callables):
+        # run callables in a single group, returning DeferredList results
+        results = yield defer.DeferredList(
+                [ self.pool.do_grouped(callable) for callable in callables ],
+                consumeErrors=True)
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def test_failure_rolls_back_only_its_own_changes(self):
+        def thdFail(conn):
+            self.insert(conn, 'b')
+            raise ValueError('no')
+        results = yield self.runGroup(self.inserter('a', 1), thdFail,
+                                      self.inserter('c', 3))
+        self.assertEqual([ ok for ok, _ in results ], [ True, False, True ])
+        results[1][1].trap(ValueError)
+        names = yield self.getNames()
+        self.assertEqual(names, [ 'a', 'c' ])
+
+    @defer.inlineCallbacks
+    def test_callable_rolls_back_its_transaction(self):
+        # after this callable's rollback, its statements are no longer in its
+        # savepoint, so the changes of its failed second attempt must not be
+        # committed with the rest
+        def thdRollback(conn):
+            for name in [ 'x', 'b' ]:
+                transaction = conn.begin()
+                self.insert(conn, name)
+                if name == 'b':
+                    raise ValueError('no')
+                transaction.rollback()
+        results = yield self.runGroup(self.inserter('a', 1), thdRollback,
+                                      self.inserter('c', 3))
+        self.assertEqual([ ok for ok, _ in results ], [ True, False, True ])
+        results[1][1].trap(ValueError)
+        names = yield self.getNames()
+        self.assertEqual(names, [ 'a', 'c' ])
+
+    @defer.inlineCallbacks
+    def test_retry(self):
+        calls = []
+        def thdLocked(conn):
+            calls.append(None)
+            self.insert(conn, 'b')
+            if len(calls) == 1:
+                raise sa.exc.OperationalError('INSERT', {},
+                        Exception('database is locked'))
+            return 2
+        results = yield self.runGroup(self.inserter('a', 1), thdLocked,
+                                      self.inserter('c', 3))
+        self.assertEqual(results, [ (True, 1), (True, 2), (True, 3) ])
+        self.assertEqual(len(calls), 2)
+        names = yield self.getNames()
+        self.assertEqual(names, [ 'a', 'b', 'c' ])
+        # each member's statistics are recorded once, when the group commits
+        stats = self.pool.getStats()['queries']
+        self.assertEqual(stats['test.test_db_pool.runGroup']['calls'], 3)
+
+
+class Retries(util.HighscoreMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore()
+        self.pool = self.highscore.db.pool
+        self.patch(self.pool, 'BACKOFF_START', 0.01)
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    @defer.inlineCallbacks
+    def test_retry_after_stop(self):
+        # a query whose retry comes due after the pool has stopped fails
+        # rather than waiting forever
+        called = defer.Deferred()
+        def thd(conn):
+            reactor.callFromThread(called.callback, None)
+            raise sa.exc.OperationalError('INSERT', {},
+                    Exception('database is locked'))
+        d = self.pool.do(thd)
+        yield called
+        self.pool.shutdown()
+        yield self.assertFailure(d, RuntimeError)
@@ -0,0 +1,351 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import time
+import sqlalchemy as sa
+from twisted.trial import unittest
+from twisted.internet import defer
+from highscore.test import util
+from highscore.const import ConstMaster as const
+
+class AggregatesMixin(object):
+    # compare the stored aggregates with ones recomputed from the points
+
+    def getState(self):
+        # return the aggregates as stored and as recomputed from scratch
+        aggregates = self.highscore.points.aggregates
+        model = self.highscore.db.model
+        def thd(conn):
+            compacted = aggregates._thd_getState(conn,
+                                                 aggregates.COMPACTED_UNTIL)
+            epoch = aggregates._thd_getState(conn, aggregates.DECAY_EPOCH)
+            daily, scores, totals = aggregates.thd_computeAggregates(conn,
+                    time.time(), epoch, compacted)
+            dailyTbl = model.points_daily
+            stored = [ dict(row) for row in conn.execute(
+                        dailyTbl.select(dailyTbl.c.day >=
+                                        aggregates.day(compacted))) ]
+            computed = [ sorted(tuple(sorted(row.items())) for row in rows)
+                         for rows in daily, totals ]
+            stored = [ sorted(tuple(sorted(row.items())) for row in rows)
+                       for rows in stored, [ dict(row) for row in
+                           conn.execute(model.user_totals.select()) ] ]
+            # compacted days are only in the rollups
+            compactedDays = sorted(tuple(row) for row in conn.execute(
+                sa.select([ dailyTbl.c.userid, dailyTbl.c.day,
+                            dailyTbl.c.scope, dailyTbl.c.points ],
+                          dailyTbl.c.day < aggregates.day(compacted))))
+            decayed = dict(tuple(row) for row in conn.execute(
+                model.decayed_totals.select()))
+            return (computed, dict((row['userid'], row['score'])
+                                   for row in scores),
+                    stored, decayed, compactedDays)
+        return self.highscore.db.pool.do(thd)
+
+    def assertConsistent(self, state, places=7):
+        # compacted days count as of midday in the decayed totals, so those
+        # only match closely for points at midday
+        computed, computedDecayed, stored, storedDecayed, _ = state
+        self.assertEqual(stored, computed)
+        self.assertEqual(sorted(storedDecayed), sorted(computedDecayed))
+        for userid, score in computedDecayed.iteritems():
+            self.assertAlmostEqual(storedDecayed[userid] / score, 1.0,
+                                   places)
+
+
+class MergePoints(AggregatesMixin, util.HighscoreMixin,
+                  unittest.TestCase):
+
+    DAY = 3600*24
+    AGES = [ 1, 3, 20, 45, 101, 102, 110, 120, 140 ] # days
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore(points=dict(merge_batch=3))
+        self.src = yield self.makeUser('src')
+        self.dst = yield self.makeUser('dst')
+
+        # points at midday, as compacted days are counted, from 1 to 140 days
+        # ago; those before 100 days ago are then compacted
+        points = self.highscore.points
+        model = self.highscore.db.model
+        today = int(time.time() // self.DAY)
+        for i in range(len(self.AGES)):
+            for userid in self.src, self.dst:
+                yield points.addPoints(userid, i + 1, 'old',
+                        source='irc', repo='bb/bb' if i % 2 else None)
+        def thd(conn):
+            pointsTbl = model.points
+            for i, age in enumerate(self.AGES):
+                conn.execute(pointsTbl.update(pointsTbl.c.comments == 'old')
+                    .where(pointsTbl.c.points == i + 1)
+                    .values(when=(today - age + 0.5) * self.DAY))
+        yield self.highscore.db.pool.do(thd)
+        yield points.rebuildAggregates()
+        yield points.compactPoints(horizon=100 * self.DAY, archive=True)
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    @defer.inlineCallbacks
+    def test_merge_matches_recomputed(self):
+        yield self.highscore.users.mergeUsers(self.src, self.dst)
+        state = yield self.getState()
+        self.assertConsistent(state)
+        self.assertEqual([ row for row in state[4] if row[0] == self.src ],
+                         [])
+
+    @defer.inlineCallbacks
+    def test_merge_with_concurrent_points(self):
+        # points for src that are written once its raw points have been
+        # moved, but before its aggregates are, stay with src
+        points = self.highscore.points
+        aggregates = points.aggregates
+        model = self.highscore.db.model
+        mergeBatch = aggregates.thd_mergeBatch
+        def thd_mergeBatch(conn, src, dst, limit):
+            if not added:
+                rows = [ dict(userid=src, when=time.time(), points=i,
+                              comments='during', source='irc', repo=None,
+                              event_type=None) for i in range(1, 6) ]
+                transaction = conn.begin()
+                conn.execute(model.points.insert(), rows)
+                aggregates.thd_addPoints(conn, rows)
+                transaction.commit()
+                added.append(True)
+            return mergeBatch(conn, src, dst, limit)
+        added = []
+        self.patch(aggregates, 'thd_mergeBatch', thd_mergeBatch)
+
+        yield self.highscore.users.mergeUsers(self.src, self.dst)
+        state = yield self.getState()
+        self.assertConsistent(state)
+        self.assertIn((('mode', const.LONGTERM_MODE), ('points', 15),
+                       ('scope', ''), ('userid', self.src)), state[2][1])
+
+        # merging again moves the stragglers without disturbing the rest
+        self.patch(aggregates, 'thd_mergeBatch', mergeBatch)
+        yield self.highscore.users.mergeUsers(self.src, self.dst)
+        state = yield self.getState()
+        self.assertConsistent(state)
+        self.assertEqual([ row for row in state[2][1]
+                           if dict(row)['userid'] == self.src ], [])
+
+
+class RebuildAggregates(util.HighscoreMixin, unittest.TestCase):
+    # rebuilds by another process, as rebuild-aggregates does them
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore()
+        self.points = self.highscore.points
+        self.aggregates = self.points.aggregates
+        self.a = yield self.makeUser('a')
+        self.b = yield self.makeUser('b')
+        yield self.points.addPoints(self.a, 5, 'a')
+        yield self.points.addPoints(self.b, 3, 'b')
+        yield self.points.seedRanks()
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    @defer.inlineCallbacks
+    def rebuild(self, beforeFinish=None):
+        aggregates = self.aggregates
+        def thd(conn):
+            plan = aggregates.thd_planRebuild(conn, time.time(), 1000)
+            for i in range(len(plan['ranges'])):
+                aggregates.thd_rebuildRange(conn, plan, i)
+            return plan
+        plan = yield self.highscore.db.pool.do(thd)
+        if beforeFinish:
+            yield beforeFinish()
+        yield self.highscore.db.pool.do(aggregates.thd_finishRebuild, plan)
+
+    @defer.inlineCallbacks
+    def getPoints(self, userid):
+        rank = yield self.points.getUserRank(userid, const.LONGTERM_MODE)
+        defer.returnValue(rank['points'])
+
+    @defer.inlineCallbacks
+    def test_bot_reseeds(self):
+        # edit the points by hand, then rebuild
+        def thd(conn):
+            pointsTbl = self.highscore.db.model.points
+            conn.execute(pointsTbl.update(pointsTbl.c.userid == self.a)
+                         .values(points=1))
+        yield self.highscore.db.pool.do(thd)
+        yield self.rebuild()
+
+        points = yield self.getPoints(self.a)
+        self.assertEqual(points, 5)
+        yield self.points.checkGeneration()
+        points = yield self.getPoints(self.a)
+        self.assertEqual(points, 1)
+
+    @defer.inlineCallbacks
+    def test_merge_during_rebuild(self):
+        yield self.assertFailure(self.rebuild(beforeFinish=lambda :
+                self.highscore.users.mergeUsers(self.a, self.b)),
+            RuntimeError)
+
+
+class WindowedBoards(AggregatesMixin, util.HighscoreMixin,
+                     unittest.TestCase):
+
+    DAY = 3600*24
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore()
+        points = self.highscore.points
+        model = self.highscore.db.model
+        users = []
+        for nick in 'abc':
+            users.append((yield self.makeUser(nick)))
+
+        # (userid, when, points, source), every 1.31 days from 80 days ago
+        self.today = today = int(time.time() // self.DAY)
+        self.points = [ (users[i % 3], (today - 80 + i * 1.31) * self.DAY,
+                         i % 7 + 1, 'irc' if i % 2 else 'github')
+                        for i in range(60) ]
+        for i, (userid, when, count, source) in enumerate(self.points):
+            yield points.addPoints(userid, count, 'p%d' % i, source=source)
+        def thd(conn):
+            pointsTbl = model.points
+            for i, (_, when, _, _) in enumerate(self.points):
+                conn.execute(pointsTbl.update(
+                    pointsTbl.c.comments == 'p%d' % i).values(when=when))
+        yield self.highscore.db.pool.do(thd)
+        yield points.rebuildAggregates()
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    def days(self, start, end):
+        # a window given in days from today
+        return (None if start is None else (self.today + start) * self.DAY,
+                None if end is None else (self.today + end) * self.DAY)
+
+    def expected(self, start, end, source=None):
+        totals = {}
+        for userid, when, count, pointSource in self.points:
+            if (start is None or when >= start) and \
+                    (end is None or when < end) and \
+                    source in (None, pointSource):
+                totals[userid] = totals.get(userid, 0) + count
+        return totals
+
+    @defer.inlineCallbacks
+    def assertBoards(self, windows):
+        for days in windows:
+            start, end = self.days(*days[:2])
+            source = days[2] if len(days) > 2 else None
+            scores = yield self.highscore.points.getHighscores(None,
+                    start=start, end=end, source=source)
+            self.assertEqual(
+                dict((row['userid'], row['points']) for row in scores),
+                self.expected(start, end, source), days)
+
+    def test_windows(self):
+        return self.assertBoards([
+            (-70.3, -10.7), # partial days at both ends
+            (-60, -35), # whole days
+            (-5.5, None),
+            (None, -45.2),
+            (-79.9, -79.2), # within a single day
+            (-70.3, -10.7, 'irc'),
+        ])
+
+    @defer.inlineCallbacks
+    def test_compaction(self):
+        deleted = yield self.highscore.points.compactPoints(
+                horizon=40 * self.DAY)
+        cutoff = (self.today - 40) * self.DAY
+        self.assertEqual(deleted,
+                         len([ p for p in self.points if p[1] < cutoff ]))
+
+        # the rollups still account for the compacted points
+        state = yield self.getState()
+        self.assertConsistent(state, places=1)
+        yield self.assertBoards([
+            (-70, -10.7), # starts on a compacted day boundary
+            (-60, -35),
+            (-5.5, None),
+            (None, -45),
+            (-100, None, 'github'),
+        ])
+
+
+class RankChanges(util.HighscoreMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore()
+        self.points = self.highscore.points
+        self.a = yield self.makeUser('a')
+        self.b = yield self.makeUser('b')
+        self.c = yield self.makeUser('c')
+        yield self.points.addPoints(self.a, 10, 'a')
+        yield self.points.addPoints(self.b, 5, 'b')
+        yield self.points.seedRanks()
+
+        # the services are not started, so consume points.add.* as
+        # startService would
+        self.changes = []
+        self.leaders = []
+        mq = self.highscore.mq
+        self.consumers = [
+            mq.consume(self.points._pointsAdded, 'points.add.*'),
+            mq.consume(lambda key, data : self.changes.append(data),
+                       'points.rank_change.*'),
+            mq.consume(lambda key, data : self.leaders.append(data),
+                       'announce.leader'),
+        ]
+
+    def tearDown(self):
+        for cons in self.consumers:
+            cons.stop_consuming()
+        self.tearDownHighscore()
+
+    def careerChanges(self):
+        return [ data for data in self.changes
+                 if data['mode'] == const.LONGTERM_MODE ]
+
+    @defer.inlineCallbacks
+    def test_overtake(self):
+        yield self.points.addPoints(self.c, 7, 'c')
+        self.assertEqual(self.careerChanges(), [
+            dict(userid=self.c, display_name='c', mode=const.LONGTERM_MODE,
+                 old_rank=3, new_rank=2, points=7, overtook=[ self.b ],
+                 overtaken_by=[]),
+        ])
+        self.assertEqual(self.leaders, [])
+
+    @defer.inlineCallbacks
+    def test_lose_the_lead(self):
+        yield self.points.addPoints(self.a, -6, 'a')
+        self.assertEqual(self.careerChanges(), [
+            dict(userid=self.a, display_name='a', mode=const.LONGTERM_MODE,
+                 old_rank=1, new_rank=2, points=4, overtook=[],
+                 overtaken_by=[ self.b ]),
+        ])
+        self.assertEqual(sorted(data['message'] for data in self.leaders), [
+            'b takes the lead on the career board from a',
+            'b takes the lead on the monthly board from a',
+        ])
+        for data in self.leaders:
+            self.assertEqual((data['userid'], data['previous_userid']),
+                             (self.b, self.a))
@@ -0,0 +1,191 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.python import failure
+from highscore.test import util
+
+class GetUserIdsAndNames(util.HighscoreMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore()
+        self.users = self.highscore.users
+
+        # record the Deferreds of calls waiting for another call's result
+        self.waiters = waiters = []
+        class Waiters(list):
+            def append(self, d):
+                waiters.append(d)
+                list.append(self, d)
+        class InFlight(dict):
+            def __setitem__(self, key, value):
+                dict.__setitem__(self, key, Waiters(value))
+        self.patch(self.users, '_identitiesInFlight', InFlight())
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    def identity(self, nick):
+        return ([ ('irc_nick', nick) ], [ ('irc_nick', nick) ], nick)
+
+    def failQueries(self, count):
+        # make the next 'count' identity queries fail, as a query would, once
+        # the calls that follow have started
+        pool = self.highscore.db.pool
+        do_grouped = pool.do_grouped
+        def fail(callable, *args, **kwargs):
+            if failures:
+                failures.pop()
+                def error():
+                    raise RuntimeError('database error')
+                return task.deferLater(reactor, 0, error)
+            return do_grouped(callable, *args, **kwargs)
+        failures = [ None ] * count
+        self.patch(pool, 'do_grouped', fail)
+
+    @defer.inlineCallbacks
+    def assertFailsAndCleansUp(self, ds):
+        results = yield defer.DeferredList(ds, consumeErrors=True)
+        for ok, result in results:
+            self.assertFalse(ok)
+            result.trap(RuntimeError)
+        self.assertEqual(self.users._identitiesInFlight, {})
+        # every waiter has been answered, and its error handled
+        self.assertNotEqual(self.waiters, [])
+        for d in self.waiters:
+            self.assertTrue(d.called)
+            self.assertFalse(isinstance(d.result, failure.Failure))
+
+    def test_failure_reaches_every_waiter(self):
+        self.failQueries(2)
+        # the second call leads for 'b' and waits on the first for 'a'
+        return self.assertFailsAndCleansUp([
+            self.users.getUserIdsAndNames([ self.identity('a') ]),
+            self.users.getUserIdsAndNames([ self.identity('b'),
+                                            self.identity('a') ]),
+            self.users.getUserIdAndName(*self.identity('a')),
+        ])
+
+    @defer.inlineCallbacks
+    def test_failure_of_another_call(self):
+        # the second call's own query succeeds, but the one it waits on fails
+        self.failQueries(1)
+        yield self.assertFailsAndCleansUp([
+            self.users.getUserIdsAndNames([ self.identity('a') ]),
+            self.users.getUserIdsAndNames([ self.identity('b'),
+                                            self.identity('a') ]),
+        ])
+        # and the identities resolve normally afterwards
+        results = yield self.users.getUserIdsAndNames([
+                self.identity('a'), self.identity('b') ])
+        self.assertEqual([ name for _, name in results ], [ 'a', 'b' ])
+
+
+class CreateUsers(util.HighscoreMixin, unittest.TestCase):
+
+    def setUp(self):
+        return self.setUpHighscore()
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    @defer.inlineCallbacks
+    def test_concurrent_batches(self):
+        users = self.highscore.users
+        batches = [ [ ([ ('irc_nick', nick) ],
+                       [ ('irc_nick', nick),
+                         ('email', nick + '@example.com') ],
+                       nick)
+                      for nick in [ '%s%d' % (prefix, i) for i in range(5) ] ]
+                    for prefix in 'ab' ]
+        results = yield defer.gatherResults([ users.getUserIdsAndNames(batch)
+                                              for batch in batches ])
+        ids = [ userid for result in results for userid, _ in result ]
+        self.assertEqual(len(set(ids)), 10)
+
+        # every identity belongs to the user created with its name
+        def thd(conn):
+            model = self.highscore.db.model
+            return [ tuple(row) for row in conn.execute(sa.select(
+                [ model.users.c.display_name, model.users_info.c.value ],
+                model.users.c.id == model.users_info.c.userid)) ]
+        rows = yield self.highscore.db.pool.do(thd)
+        self.assertEqual(len(rows), 20)
+        for name, value in rows:
+            self.assertEqual(value.split('@')[0], name)
+        for batch, result in zip(batches, results):
+            self.assertEqual([ name for _, name in result ],
+                             [ identity[2] for identity in batch ])
+
+
+class TypeCache(util.HighscoreMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore(db=dict(group_commit_window=0.01))
+        self.users = self.highscore.users
+        self.pool = self.highscore.db.pool
+        self.patch(self.pool, 'BACKOFF_START', 0.01)
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    def getUser(self, nick):
+        return self.users.getUserIdAndName(
+                [ ('irc_nick', nick) ],
+                [ ('irc_nick', nick), ('email', nick + '@example.com') ],
+                nick)
+
+    @defer.inlineCallbacks
+    def assertTypeCacheMatches(self):
+        def thd(conn):
+            tbl = self.highscore.db.model.user_attr_types
+            return dict((row.type, row.id) for row in conn.execute(
+                        tbl.select()))
+        types = yield self.pool.do(thd)
+        self.assertEqual(self.users._typeCache, types)
+
+    @defer.inlineCallbacks
+    def test_group_rollback(self):
+        def nameKey(name):
+            raise RuntimeError('no')
+        self.patch(self.users, 'nameKey', nameKey)
+        yield self.assertFailure(self.getUser('a'), RuntimeError)
+        yield self.assertTypeCacheMatches()
+
+    @defer.inlineCallbacks
+    def test_group_retry(self):
+        # queue a callable that fails once, retryably, behind each one
+        calls = []
+        def thdLocked(conn):
+            calls.append(None)
+            if len(calls) == 1:
+                raise sa.exc.OperationalError('INSERT', {},
+                        Exception('database is locked'))
+        do_grouped = self.pool.do_grouped
+        def grouped(callable, *args, **kwargs):
+            d = do_grouped(callable, *args, **kwargs)
+            do_grouped(thdLocked)
+            return d
+        self.patch(self.pool, 'do_grouped', grouped)
+
+        userid, _ = yield self.getUser('a')
+        self.assertEqual(len(calls), 2)
+        yield self.assertTypeCacheMatches()
+        found = yield self.users.findUser('email', 'a@example.com')
+        self.assertEqual(found, (userid, 'a'))
@@ -0,0 +1,62 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from highscore.app import Config
+from highscore.plugins import irc
+from highscore.test import util
+
+class MergeUsers(util.HighscoreMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore()
+        config = Config(dict(plugins=dict(irc=dict(
+            channel='#highscore', nickname='highscore',
+            admins=[ 'dustin!dustin@*.example.com' ]))))
+        self.protocol = irc.IrcProtocol(self.highscore, config)
+        self.messages = []
+        self.patch(self.protocol, 'publicMsg', self.messages.append)
+
+        self.a = yield self.makeUser('a')
+        self.b = yield self.makeUser('b')
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    @defer.inlineCallbacks
+    def assertUsers(self, expected):
+        found = yield defer.gatherResults([
+                self.highscore.users.findUser('irc_nick', nick)
+                for nick in [ 'a', 'b' ] ])
+        self.assertEqual([ userid for userid, _ in found ], expected)
+
+    @defer.inlineCallbacks
+    def test_non_admin_refused(self):
+        # the admin's nick, from somewhere else; the refusal is immediate
+        self.protocol.privmsg('dustin!dustin@elsewhere.net', '#highscore',
+                              'merge_users a b')
+        self.assertEqual(self.messages,
+                         [ 'dustin: only admins can merge users' ])
+        yield self.assertUsers([ self.a, self.b ])
+
+    @defer.inlineCallbacks
+    def test_admin(self):
+        yield self.protocol.mergeUsers('Dustin!dustin@host.EXAMPLE.com',
+                                       [ 'a', 'b' ])
+        self.assertEqual(self.messages[-1],
+                         'Dustin: merged a into b, moving 0 points')
+        yield self.assertUsers([ self.b, self.b ])
@@ -0,0 +1,93 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import re
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.web.test.requesthelper import DummyRequest
+from highscore.test import util
+from highscore.www import resource
+
+class UserPoints(util.HighscoreMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield self.setUpHighscore()
+        self.patch(resource.UserPointsResource, 'PAGE_SIZE', 4)
+        self.userid = yield self.makeUser('a')
+
+        # ten points, some of which share a time, at whole and fractional
+        # seconds
+        self.times = [ 1000000000, 1000000000, 1000000000, 1000000001.25,
+                       1000000001.25, 1000000002, 1000000003.5,
+                       1000000003.5, 1000000003.5, 1000000004 ]
+        for i in range(len(self.times)):
+            yield self.highscore.points.addPoints(self.userid, 1, 'p%d' % i)
+        def thd(conn):
+            pointsTbl = self.highscore.db.model.points
+            for i, when in enumerate(self.times):
+                conn.execute(pointsTbl.update(
+                    pointsTbl.c.comments == 'p%d' % i).values(when=when))
+        yield self.highscore.db.pool.do(thd)
+
+    def tearDown(self):
+        self.tearDownHighscore()
+
+    @defer.inlineCallbacks
+    def render(self, **args):
+        request = DummyRequest([])
+        request.args = dict((k, [ v ]) for k, v in args.iteritems())
+        d = request.notifyFinish()
+        resource.UserPointsResource(self.highscore, self.userid).render(
+                request)
+        yield d
+        defer.returnValue((request.responseCode, ''.join(request.written)))
+
+    @defer.inlineCallbacks
+    def test_pages(self):
+        # follow the 'older' links from the first page to the last
+        seen = []
+        args = {}
+        while True:
+            code, html = yield self.render(**args)
+            self.assertIn(code, (None, 200))
+            page = re.findall(r'class="comments">(p\d+)<', html)
+            self.assertTrue(0 < len(page) <= 4)
+            seen.extend(page)
+            mo = re.search(r'href="[^"]*\?before=([^"]*)"', html)
+            if not mo:
+                break
+            args = dict(before=mo.group(1))
+        # newest first, each point exactly once
+        self.assertEqual(sorted(seen), sorted('p%d' % i for i in range(10)))
+        self.assertEqual(len(seen), 10)
+        whens = [ self.times[int(name[1:])] for name in seen ]
+        self.assertEqual(whens, sorted(whens, reverse=True))
+
+    def test_cursor_round_trip(self):
+        res = resource.UserPointsResource(self.highscore, self.userid)
+        for when in [ 1000000000, 1000000000L, 1000000001.25,
+                      1234567890.123456 ]:
+            cursor = res.makeCursor(dict(when=when, pointsid=17))
+            request = DummyRequest([])
+            request.args = dict(before=[ cursor ])
+            self.assertEqual(res.getCursor(request), (when, 17))
+
+    @defer.inlineCallbacks
+    def test_bad_cursor(self):
+        for before in [ 'garbage', 'abc-12', '1000000000-x' ]:
+            code, html = yield self.render(before=before)
+            self.assertEqual(code, 400)
+            self.assertIn("malformed 'before' argument", html)
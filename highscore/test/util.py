@@ -0,0 +1,44 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+from twisted.internet import defer
+from highscore.app import Highscore
+
+class HighscoreMixin(object):
+    # set up a Highscore instance with a fresh SQLite database in a temporary
+    # directory; call tearDownHighscore from tearDown
+
+    @defer.inlineCallbacks
+    def setUpHighscore(self, **config):
+        basedir = os.path.abspath(self.mktemp())
+        os.makedirs(basedir)
+        cfg = dict(basedir=basedir, db=dict(url='sqlite:///highscore.sqlite'),
+                   www=dict(port=0), plugins={})
+        for section, values in config.iteritems():
+            cfg.setdefault(section, {}).update(values)
+        self.highscore = Highscore(cfg)
+        yield self.highscore.setup()
+
+    def tearDownHighscore(self):
+        self.highscore.db.pool.shutdown()
+
+    @defer.inlineCallbacks
+    def makeUser(self, nick):
+        userid, _ = yield self.highscore.users.getUserIdAndName(
+                matchInfo=[ ('irc_nick', nick) ],
+                suggestedInfo=[ ('irc_nick', nick) ],
+                suggestedDisplayName=nick)
+        defer.returnValue(userid)
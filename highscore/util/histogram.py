@@ -0,0 +1,80 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import math
+import time
+
+class RollingHistogram(object):
+    # Counts of non-negative values (e.g., durations in seconds) in buckets
+    # whose upper bounds are SMALLEST * 2**i, covering the last `window`
+    # seconds.  The window is kept as `slots` sub-windows, and the oldest is
+    # discarded as each new one begins, so adding a value is O(1) and memory
+    # is bounded by slots * the number of buckets in use.
+
+    SMALLEST = 0.0001
+
+    def __init__(self, window=300, slots=10, clock=time.time):
+        self.window = window
+        self.slotLength = float(window) / slots
+        self.clock = clock
+        self._slots = [] # [ (slot number, {bucket: count}, [ sum, max ]) ]
+
+    def _bucket(self, value):
+        if value <= self.SMALLEST:
+            return 0
+        return int(math.ceil(math.log(value / self.SMALLEST, 2)))
+
+    def add(self, value):
+        now = int(self.clock() // self.slotLength)
+        if not self._slots or self._slots[-1][0] != now:
+            self._slots.append((now, {}, [ 0.0, 0.0 ]))
+            self._expire(now)
+        _, buckets, totals = self._slots[-1]
+        bucket = self._bucket(value)
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+        totals[0] += value
+        totals[1] = max(totals[1], value)
+
+    def _expire(self, now):
+        oldest = now - int(self.window / self.slotLength) + 1
+        while self._slots and self._slots[0][0] < oldest:
+            self._slots.pop(0)
+
+    def getStats(self):
+        # return the count, mean and maximum of the values in the window, and
+        # upper bounds for the 50th, 90th and 99th percentiles
+        self._expire(int(self.clock() // self.slotLength))
+        buckets = {}
+        total = maximum = 0.0
+        for _, slotBuckets, (slotTotal, slotMax) in self._slots:
+            for bucket, count in slotBuckets.iteritems():
+                buckets[bucket] = buckets.get(bucket, 0) + count
+            total += slotTotal
+            maximum = max(maximum, slotMax)
+        count = sum(buckets.itervalues())
+        stats = dict(count=count, mean=total / count if count else 0.0,
+                     max=maximum)
+
+        cumulative = 0
+        percentiles = [ (50, 'p50'), (90, 'p90'), (99, 'p99') ]
+        for bucket in sorted(buckets):
+            cumulative += buckets[bucket]
+            while percentiles \
+                    and cumulative * 100 >= percentiles[0][0] * count:
+                stats[percentiles.pop(0)[1]] = min(
+                        self.SMALLEST * 2 ** bucket, maximum)
+        for _, name in percentiles:
+            stats[name] = 0.0
+        return stats
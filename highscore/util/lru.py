@@ -0,0 +1,71 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import collections
+
+class LRUCache(object):
+    # A dictionary holding at most maxSize entries, discarding the least
+    # recently used entry to make room for a new one.  Lookups and insertions
+    # are O(1).  Counts of hits, misses and evictions are kept for
+    # monitoring.
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # move it to the most-recently-used end
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        return self._entries.pop(key, default)
+
+    def discardWhere(self, predicate):
+        # remove every entry for which predicate(key, value) is true; this
+        # takes O(n), so it is meant for infrequent invalidation
+        for key, value in self._entries.items():
+            if predicate(key, value):
+                del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def getStats(self):
+        return dict(size=len(self._entries), max_size=self.maxSize,
+                    hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
@@ -0,0 +1,194 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import random
+
+# An indexable skiplist, based on
+# http://code.activestate.com/recipes/576930/.  Each link records how many
+# bottom-level nodes it spans, so that finding the position of a value, or
+# the value at a position, takes O(log n) steps.
+
+class _End(object):
+    # sentinel that compares greater than any value
+
+    def __cmp__(self, other):
+        return 1
+
+class _Node(object):
+
+    __slots__ = [ 'value', 'next', 'width' ]
+
+    def __init__(self, value, next, width):
+        self.value = value
+        self.next = next
+        self.width = width
+
+_NIL = _Node(_End(), [], [])
+
+class IndexableSkiplist(object):
+
+    # enough for 2**MAX_LEVELS values before operations begin to degrade
+    MAX_LEVELS = 24
+
+    def __init__(self):
+        self.size = 0
+        self.head = _Node('HEAD', [_NIL] * self.MAX_LEVELS,
+                                  [1] * self.MAX_LEVELS)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return self._node(i).value
+
+    def _node(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        node = self.head
+        i += 1
+        for level in reversed(xrange(self.MAX_LEVELS)):
+            while node.width[level] <= i:
+                i -= node.width[level]
+                node = node.next[level]
+        return node
+
+    def slice(self, start, stop):
+        # return the values at positions start through stop-1, in O(log n + k)
+        start = max(start, 0)
+        stop = min(stop, self.size)
+        if start >= stop:
+            return []
+        node = self._node(start)
+        values = []
+        for _ in xrange(stop - start):
+            values.append(node.value)
+            node = node.next[0]
+        return values
+
+    def index(self, value):
+        # return the position of value, which must be present
+        node = self.head
+        pos = 0
+        for level in reversed(xrange(self.MAX_LEVELS)):
+            while node.next[level].value < value:
+                pos += node.width[level]
+                node = node.next[level]
+        if node.next[0].value != value:
+            raise ValueError(value)
+        return pos
+
+    def insert(self, value):
+        # find the last node on each level that is <= value
+        chain = [ None ] * self.MAX_LEVELS
+        steps_at_level = [ 0 ] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(xrange(self.MAX_LEVELS)):
+            while node.next[level].value <= value:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        # link the new node in at a random number of levels
+        d = 1
+        while d < self.MAX_LEVELS and random.random() < 0.5:
+            d += 1
+        newnode = _Node(value, [ None ] * d, [ None ] * d)
+        steps = 0
+        for level in xrange(d):
+            prevnode = chain[level]
+            newnode.next[level] = prevnode.next[level]
+            prevnode.next[level] = newnode
+            newnode.width[level] = prevnode.width[level] - steps
+            prevnode.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in xrange(d, self.MAX_LEVELS):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, value):
+        # find the last node on each level that is < value
+        chain = [ None ] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(xrange(self.MAX_LEVELS)):
+            while node.next[level].value < value:
+                node = node.next[level]
+            chain[level] = node
+        if chain[0].next[0].value != value:
+            raise ValueError(value)
+
+        # unlink it from each level where it appears
+        d = len(chain[0].next[0].next)
+        for level in xrange(d):
+            prevnode = chain[level]
+            prevnode.width[level] += prevnode.next[level].width[level] - 1
+            prevnode.next[level] = prevnode.next[level].next[level]
+        for level in xrange(d, self.MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+
+class RankIndex(object):
+    # The scores for a single leaderboard, ranked the same way as the
+    # leaderboard queries: by score descending, then by userid descending.
+    # Ranks are 1-based.
+
+    def __init__(self):
+        self.scores = {}
+        self.order = IndexableSkiplist()
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __contains__(self, userid):
+        return userid in self.scores
+
+    def clear(self):
+        self.scores = {}
+        self.order = IndexableSkiplist()
+
+    def setScore(self, userid, score):
+        self.removeUser(userid)
+        self.scores[userid] = score
+        self.order.insert((-score, -userid))
+
+    def addScore(self, userid, delta):
+        self.setScore(userid, self.scores.get(userid, 0) + delta)
+
+    def removeUser(self, userid):
+        if userid in self.scores:
+            self.order.remove((-self.scores.pop(userid), -userid))
+
+    def getScore(self, userid):
+        return self.scores.get(userid)
+
+    def getRank(self, userid):
+        if userid not in self.scores:
+            return None
+        return self.order.index((-self.scores[userid], -userid)) + 1
+
+    def getRange(self, first, last):
+        # return (rank, userid, score) for ranks first through last
+        first = max(first, 1)
+        return [ (rank, -negUserid, -negScore)
+                 for rank, (negScore, negUserid) in enumerate(
+                     self.order.slice(first - 1, last), first) ]
+
+    def getNeighbours(self, userid, k):
+        # return (rank, userid, score) for the k users ranked immediately
+        # above and below userid, and for userid itself
+        rank = self.getRank(userid)
+        if rank is None:
+            return []
+        return self.getRange(rank - k, rank + k)
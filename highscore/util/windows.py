@@ -0,0 +1,72 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import re
+import time
+import calendar
+
+# Parsing of the leaderboard time windows that users can ask for on the web
+# and on IRC.  All times are UTC.
+#
+#   week                    - since the start of this week (Monday)
+#   month                   - since the start of this calendar month
+#   7d                      - the last 7 days (any number of days)
+#   since:2012-08-01        - since a date
+#   2012-08-01..2012-09-01  - from one date up to (not including) another
+
+DAY = 3600*24
+
+days_re = re.compile(r'^(\d+)d$')
+date_re = r'(\d{4}-\d{2}-\d{2})'
+since_re = re.compile(r'^since:%s$' % date_re)
+range_re = re.compile(r'^%s\.\.%s$' % (date_re, date_re))
+
+def parseDate(date):
+    return calendar.timegm(time.strptime(date, '%Y-%m-%d'))
+
+def parseWindow(spec, now=None):
+    """Return (start, end, description) for a window specification, raising
+    ValueError if it is not valid."""
+    if now is None:
+        now = time.time()
+    today = int(now // DAY) * DAY
+    spec = spec.strip()
+
+    if spec == 'week':
+        weekday = time.gmtime(now).tm_wday
+        return today - weekday * DAY, now, 'this week'
+
+    if spec == 'month':
+        tm = time.gmtime(now)
+        start = calendar.timegm((tm.tm_year, tm.tm_mon, 1, 0, 0, 0))
+        return start, now, 'this month'
+
+    mo = days_re.match(spec)
+    if mo:
+        days = int(mo.group(1))
+        return now - days * DAY, now, 'last %d days' % days
+
+    mo = since_re.match(spec)
+    if mo:
+        return parseDate(mo.group(1)), now, 'since %s' % mo.group(1)
+
+    mo = range_re.match(spec)
+    if mo:
+        start, end = parseDate(mo.group(1)), parseDate(mo.group(2))
+        if end <= start:
+            raise ValueError("window %r is empty" % (spec,))
+        return start, end, '%s to %s' % (mo.group(1), mo.group(2))
+
+    raise ValueError("unrecognized window %r" % (spec,))
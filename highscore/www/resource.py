@@ -14,11 +14,13 @@
 # Copyright Buildbot Team Members
 
 import time
+import json
 from twisted.python import log, util
 from twisted.internet import defer
 from twisted.web import resource, server, template, static
 
 from highscore.const import ConstMaster as const
+from highscore.util import windows
 
 class Resource(resource.Resource):
 
@@ -61,11 +63,12 @@ class HighscoresElement(template.Element):
 
     loader = template.XMLFile(util.sibpath(__file__, 'templates/leaderboard.xhtml'))
 
-    def __init__(self, highscore, scores, ltscores):
+    def __init__(self, highscore, scores, ltscores, heading='Monthly'):
         template.Element.__init__(self)
         self.highscore = highscore
         self.scores = scores
         self.ltscores = ltscores
+        self.heading = heading
 
     @template.renderer
     def title(self, request, tag):
@@ -89,7 +92,7 @@ class HighscoresElement(template.Element):
 
     @template.renderer
     def monthly_header(self, request, tag):
-        h3 = template.tags.h3('Monthly', class_='monthly')
+        h3 = template.tags.h3(self.heading, class_='monthly')
         return h3
 
     @template.renderer
@@ -178,19 +181,75 @@ class HighscoresElement(template.Element):
 
 class HighscoresResource(Resource):
 
+    LIMIT = 10
+
     def __init__(self, highscore):
         Resource.__init__(self, highscore) 
         self.highscore = highscore
       
+    FILTERS = ('source', 'repo', 'event_type')
+
     @defer.inlineCallbacks
     def content(self, request):
-        scores = yield self.highscore.points.getHighscores(const.MONTHLY_MODE)
-        ltscores = yield self.highscore.points.getHighscores(const.LONGTERM_MODE)
+        # ?source=, ?repo= or ?event_type= limits both boards to those points
+        filters = dict((name, request.args[name][0])
+                       for name in self.FILTERS if name in request.args)
+        if len(filters) > 1:
+            request.setResponseCode(400)
+            defer.returnValue("only one of %s may be given"
+                              % (', '.join(self.FILTERS),))
+
+        # ?window=<spec> replaces the monthly board with one for that window;
+        # see highscore.util.windows for the syntax
+        if 'window' in request.args:
+            window = request.args['window'][0]
+            try:
+                _, _, heading = windows.parseWindow(window)
+            except ValueError, e:
+                request.setResponseCode(400)
+                defer.returnValue(str(e))
+            scores = yield self.highscore.points.getHighscores(None,
+                    limit=self.LIMIT, window=window, **filters)
+            heading = heading[0].upper() + heading[1:]
+        else:
+            scores = yield self.highscore.points.getHighscores(
+                    const.MONTHLY_MODE, limit=self.LIMIT, **filters)
+            heading = 'Monthly'
+        ltscores = yield self.highscore.points.getHighscores(
+                const.LONGTERM_MODE, limit=self.LIMIT, **filters)
+        if filters:
+            heading += ' (%s)' % (filters.values()[0],)
 
         request.write('<!doctype html>\n')
         defer.returnValue((yield template.flattenString(request,
                                 HighscoresElement(self.highscore, scores,
-                                                  ltscores))))
+                                                  ltscores, heading))))
+
+
+class SearchResource(Resource):
+    # /search?q=<prefix>, returning a JSON list of the matching users
+
+    contentType = 'application/json'
+    LIMIT = 20
+
+    @defer.inlineCallbacks
+    def content(self, request):
+        prefix = request.args.get('q', [''])[0].decode('utf-8', 'replace')
+        users = yield self.highscore.users.searchUsers(prefix,
+                                                       limit=self.LIMIT)
+        for user in users:
+            user['url'] = self.highscore.www.makeUrl('user', user['userid'])
+        defer.returnValue(json.dumps(users))
+
+
+class StatsResource(Resource):
+    # /stats, returning JSON statistics on database queries and caches
+
+    contentType = 'application/json'
+
+    def content(self, request):
+        return json.dumps(dict(db=self.highscore.db.pool.getStats(),
+                    users=self.highscore.users.getIdentityCacheStats()))
 
 
 class UsersPointsResource(Resource):
@@ -207,16 +266,32 @@ class UserPointsElement(template.Element):
 
     loader = template.XMLFile(util.sibpath(__file__, 'templates/pointslist.xhtml'))
 
-    def __init__(self, highscore, display_name, points):
+    def __init__(self, highscore, display_name, points, ranks, older_url):
         template.Element.__init__(self)
         self.highscore = highscore
         self.display_name = display_name
         self.points = points
+        self.ranks = ranks
+        self.older_url = older_url
 
     @template.renderer
     def title(self, request, tag):
         return tag("Points for %s" % (self.display_name,))
 
+    def getPosStr(self, position):
+        posDict = {1 : 'st', 2: 'nd', 3: 'rd'}
+        return str(position) + posDict.get(position, 'th')
+
+    @template.renderer
+    def rank_badge(self, request, tag):
+        ul = template.tags.ul()
+        tag(ul, class_='ranks')
+        for label, rank in self.ranks:
+            ul(template.tags.li("%s of %d %s" % (
+                self.getPosStr(rank['rank']), rank['users'], label),
+                class_="rank"))
+        return ul
+
     @template.renderer
     def main_table(self, request, tag):
         ul = template.tags.ul()
@@ -237,23 +312,73 @@ class UserPointsElement(template.Element):
             ul(li)
         return ul
 
+    @template.renderer
+    def older_link(self, request, tag):
+        if not self.older_url:
+            return ''
+        return template.tags.a('older', class_="older", href=self.older_url)
+
 
 class UserPointsResource(Resource):
 
+    PAGE_SIZE = 50
+
     def __init__(self, highscore, userid):
         Resource.__init__(self, highscore)
         self.highscore = highscore
         self.userid = userid
 
+    def getCursor(self, request):
+        # the 'before' argument is "$when-$pointsid"; returns None if it is
+        # not given, and raises ValueError if it is malformed
+        if 'before' not in request.args:
+            return None
+        when, pointsid = request.args['before'][0].rsplit('-', 1)
+        return float(when), int(pointsid)
+
+    def makeCursor(self, point):
+        # the inverse of getCursor.  'when' is an Integer column, but may be
+        # a long (from MySQL), or a float (from SQLite), which must not be
+        # rounded.
+        when = point['when']
+        if isinstance(when, float):
+            when = repr(when)
+        else:
+            when = '%d' % when
+        return '%s-%d' % (when, point['pointsid'])
+
     @defer.inlineCallbacks
     def content(self, request):
-        points = yield self.highscore.points.getUserPoints(self.userid)
+        try:
+            before = self.getCursor(request)
+        except ValueError:
+            request.setResponseCode(400)
+            defer.returnValue("malformed 'before' argument")
+
+        # fetch one extra row to find out whether there is an older page
+        points = yield self.highscore.points.getUserPoints(self.userid,
+                before=before, limit=self.PAGE_SIZE + 1)
+        older_url = None
+        if len(points) > self.PAGE_SIZE:
+            points = points[:self.PAGE_SIZE]
+            older_url = '%s?before=%s' % (
+                    self.highscore.www.makeUrl('user', self.userid),
+                    self.makeCursor(points[-1]))
+
         display_name = yield self.highscore.users.getDisplayName(self.userid)
 
+        ranks = []
+        for mode, label in [ (const.MONTHLY_MODE, 'this month'),
+                             (const.LONGTERM_MODE, 'career') ]:
+            rank = yield self.highscore.points.getUserRank(self.userid, mode)
+            if rank:
+                ranks.append((label, rank))
+
         request.write('<!doctype html>\n')
         defer.returnValue((yield template.flattenString(request,
                                 UserPointsElement(self.highscore,
-                                                display_name, points))))
+                                                display_name, points,
+                                                ranks, older_url))))
 
 class PluginsResource(Resource):
 
@@ -36,6 +36,8 @@ class WWWService(service.MultiService):
         root.putChild('', resource.HighscoresResource(self.highscore))
         root.putChild('static', static.File(util.sibpath(__file__, 'static')))
         root.putChild('user', resource.UsersPointsResource(self.highscore))
+        root.putChild('search', resource.SearchResource(self.highscore))
+        root.putChild('stats', resource.StatsResource(self.highscore))
         root.putChild('plugins', resource.PluginsResource(self.highscore))
 
         self.site = server.Site(root)
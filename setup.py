@@ -22,6 +22,7 @@ setup(
     author='Dustin J. Mitchell',
     author_email='dustin@cs.uchicago.edu',
     packages=['highscore'],
+    scripts=['bin/highscore'],
     install_requires=[
         'twisted >= 11.0.0',
         'sqlalchemy >= 0.6.0, <= 0.7.10',